@@ -16,41 +16,537 @@
     Contact: code@inmanta.com
 """
 
+import hashlib
+import html
+import io
+import json
+import logging
 import os
 import re
-import subprocess
-from typing import List
+import shlex
+import string
+from array import array
+from collections import Counter
+from collections.abc import Mapping
+from typing import Callable, Dict, Iterator, List, Optional, Set, TextIO, Tuple
+
+from inmanta_plugins.graph.cache import RenderCache
+from inmanta_plugins.graph.formats import FORMATS
+from inmanta_plugins.graph.render import bindings_available, make_job, make_plantuml_jobs, render_all, select_engine
+from inmanta_plugins.graph.report import Report
+from inmanta_plugins.graph.viewer import VIEWER_TYPE, write_viewer
 
 import inmanta
 from inmanta import config
 from inmanta.ast.attribute import RelationAttribute
 from inmanta.ast.entity import Entity
 from inmanta.data import convert_boolean
+from inmanta.execute.util import NoneValue
 from inmanta.export import export
 
+LOGGER = logging.getLogger(__name__)
+
 
 class ParseException(Exception):
     pass
 
 
+# buffer size used to stream generated files to disk
+WRITE_BUFFER_SIZE = 2**20
+
 OPT_RE = re.compile(r"""\s?(:?([^,=]+)=("[^"]+"|[^,]+))+""")
+# the comma separated items of an options string, commas between double quotes do not separate items
+OPT_ITEM_RE = re.compile(r'(?:"[^"]*"|[^,"])+')
+# an attribute predicate: attr="value", attr!="value" or attr~"regex", the quotes are optional
+PREDICATE_RE = re.compile(r'^\s*(?P<attribute>\w+)\s*(?P<operator>~|!=|=)\s*(?P<value>"[^"]*"|[^\s"]+)\s*$')
+
+
+def unquote(value: str) -> str:
+    """
+    Remove the double quotes around an option value
+    """
+    if len(value) > 1 and value[0] == '"' and value[-1] == '"':
+        return value[1:-1]
+    return value
+
+
+def literal(value: object) -> str:
+    """
+    The literal of a primitive value in the model: true, false, null, numbers without a trailing .0 and strings as they are
+    """
+    if value is None or isinstance(value, NoneValue):
+        return "null"
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, list):
+        return "[%s]" % ", ".join(literal(v) for v in value)
+    return str(value)
+
+
+class Predicate(object):
+    """
+    An attribute predicate of a filter line. Values are compared on their literal in the model, see literal. An instance
+    that does not have the attribute, or where the attribute has no value, does not match. A relation can not be
+    compared with a value, see check_predicates.
+    """
+
+    def __init__(self, text: str) -> None:
+        match = PREDICATE_RE.match(text)
+        if not match:
+            raise ParseException()
+
+        self.text = text.strip()
+        self.attribute = match.group("attribute")
+        self.operator = match.group("operator")
+        self.value = unquote(match.group("value"))
+
+        self.regex = None
+        if self.operator == "~":
+            try:
+                self.regex = re.compile(self.value)
+            except re.error:
+                raise ParseException()
+
+    def __call__(self, attributes: "Mapping[str, object]") -> bool:
+        if self.attribute not in attributes:
+            return False
+        try:
+            value = attributes[self.attribute]
+        except Exception:
+            # optional attributes without a value
+            return False
+        if NodeNames._is_instance(value) or (isinstance(value, list) and any(NodeNames._is_instance(v) for v in value)):
+            return False
+        value = literal(value)
+
+        if self.regex is not None:
+            return self.regex.search(value) is not None
+        return (value == self.value) == (self.operator == "=")
+
+    def __repr__(self) -> str:
+        return self.text
+
+
+def parse_where(clause: str) -> "List[Predicate]":
+    """
+    Parse the predicates of a where clause, joined with and
+    """
+    return [Predicate(text) for text in re.split(r'\s+and\s+(?=(?:[^"]*"[^"]*")*[^"]*$)', clause.strip())]
+
+
+class Hop(object):
+    """
+    A step of a relation path: the name of the relation, optionally followed by type and predicate filters, for example
+    files|std::ConfigFile or files|path~"^/etc/". Targets that do not pass the filters are not followed any further.
+    """
+
+    def __init__(self, text: str) -> None:
+        parts = re.findall(r'(?:"[^"]*"|[^|"])+', text)
+        if not parts or "|".join(parts) != text:
+            raise ParseException()
+
+        self.name = parts[0]
+        self.types: "List[str]" = []
+        self.predicates: "List[Predicate]" = []
+        for part in parts[1:]:
+            if PREDICATE_RE.match(part):
+                self.predicates.append(Predicate(part))
+            elif "::" in part:
+                self.types.append(part)
+            else:
+                raise ParseException()
+
+    @property
+    def filtered(self) -> bool:
+        return bool(self.types or self.predicates)
+
+    def accepts(self, instance, attributes: "AttributeCache") -> bool:
+        if self.types and not any(attributes.is_a(instance, name) for name in self.types):
+            return False
+        if self.predicates:
+            instance_attributes = attributes.get(instance)
+            return all(predicate(instance_attributes) for predicate in self.predicates)
+        return True
+
+
+_hops: "Dict[str, Hop]" = {}
+
+
+def parse_hop(text: str) -> Hop:
+    """
+    Parse a step of a relation path, steps are cached on their text because they are parsed for every traversal
+    """
+    hop = _hops.get(text)
+    if hop is None:
+        hop = Hop(text)
+        _hops[text] = hop
+    return hop
+
+
+class InstanceAttributes(Mapping):
+    """
+    A read-only view on the attribute values of an instance. Values are only read from the instance when they are
+    accessed, and only once.
+    """
+
+    __slots__ = ("instance", "values")
+
+    def __init__(self, instance: "inmanta.execute.runtime.Instance") -> None:
+        self.instance = instance
+        self.values = {}
+
+    def __getitem__(self, name: str) -> object:
+        try:
+            return self.values[name]
+        except KeyError:
+            value = self.instance.slots[name].value
+            self.values[name] = value
+            return value
+
+    def __contains__(self, name: object) -> bool:
+        return name in self.instance.slots
+
+    def __iter__(self) -> "Iterator[str]":
+        return iter(self.instance.slots)
+
+    def __len__(self) -> int:
+        return len(self.instance.slots)
+
+
+class AttributeCache(object):
+    """
+    The attribute views of all instances, shared by all lines of all diagrams
+    """
+
+    def __init__(self) -> None:
+        self.attributes = {}
+        # memoized relation traversals, by start instance, remaining relation path and fan-out cap
+        self.targets: "Dict[Tuple[object, Tuple[str, ...], Optional[int]], Tuple[object, ...]]" = {}
+        # the type filters of relation paths, by entity type and type name
+        self.types: "Dict[Tuple[Entity, str], bool]" = {}
+
+    def get(self, instance: "inmanta.execute.runtime.Instance") -> InstanceAttributes:
+        attributes = self.attributes.get(instance)
+        if attributes is None:
+            attributes = InstanceAttributes(instance)
+            self.attributes[instance] = attributes
+        return attributes
+
+    def is_a(self, instance, type_name: str) -> bool:
+        """
+        Is the instance an instance of the given entity type or one of its subtypes
+        """
+        if not hasattr(instance, "type"):
+            return False
+        key = (instance.type, type_name)
+        result = self.types.get(key)
+        if result is None:
+            result = instance.type.get_full_name() == type_name or any(
+                parent.get_full_name() == type_name for parent in instance.type.get_all_parent_entities()
+            )
+            self.types[key] = result
+        return result
+
+
+class NodeNames(object):
+    """
+    Deterministic node names, derived from the model instead of the memory address of the instance, so the same model
+    always results in the same dot file.
+
+    The name is the entity type and a hash of the attributes of the first index of the type. Instances of a type without
+    an index are identified by their primitive attributes and by the instances they refer to, so instances with the same
+    attribute values get a different name when they are related to different instances. Relations in an index are
+    identified by the name of the instance they refer to.
+
+    The instances of a type are not returned in a stable order, so a name never depends on the order in which the
+    instances are named.
+    """
+
+    def __init__(self) -> None:
+        self.names: "Dict[object, str]" = {}
+        self.used: "Set[str]" = set()
+        self._in_progress: "Set[object]" = set()
+        # set while the related instances of an instance are described, their names are not stored
+        self._describing = False
+
+    def get(self, instance: "inmanta.execute.runtime.Instance") -> str:
+        name = self.names.get(instance)
+        if name is None:
+            name = self._unique(self._compute(instance))
+            self.names[instance] = name
+        return name
+
+    def _unique(self, name: str) -> str:
+        # instances that can not be told apart, not even by the instances they refer to, get a sequence number
+        unique = name
+        sequence = 1
+        while unique in self.used:
+            unique = "%s_%d" % (name, sequence)
+            sequence += 1
+        self.used.add(unique)
+        return unique
+
+    def _compute(self, instance, related: bool = True) -> str:
+        """
+        :param related: Identify the instances of a type without an index by the instances they refer to as well
+        """
+        if not self._is_instance(instance):
+            # a node that does not represent an instance, such as a summary node, is named after its key
+            return "%s_%s" % (type(instance).__name__, hashlib.sha1(str(instance).encode()).hexdigest()[:12])
+
+        entity = instance.type
+        type_name = entity.get_full_name()
+        indices = entity.get_indices()
+
+        self._in_progress.add(instance)
+        try:
+            if indices:
+                key = ["%s=%s" % (name, self._value(instance.slots[name])) for name in indices[0]]
+            else:
+                key = [
+                    "%s=%s" % (name, self._value(slot))
+                    for name, slot in sorted(instance.slots.items())
+                    if name != "self" and not isinstance(entity.get_attribute(name), RelationAttribute)
+                ]
+                if related:
+                    key += [
+                        "%s->%s" % (name, self._related(instance, slot))
+                        for name, slot in sorted(instance.slots.items())
+                        if name != "self" and isinstance(entity.get_attribute(name), RelationAttribute)
+                    ]
+        finally:
+            self._in_progress.discard(instance)
+
+        digest = hashlib.sha1(("%s[%s]" % (type_name, ",".join(key))).encode()).hexdigest()[:12]
+        return "%s_%s" % (re.sub(r"\W+", "_", type_name), digest)
+
+    def _value(self, slot) -> str:
+        try:
+            value = slot.value
+        except Exception:
+            return "?"
+
+        if isinstance(value, list):
+            return "[%s]" % ",".join(sorted(self._primitive(v) for v in value))
+        return self._primitive(value)
+
+    def _related(self, instance, slot) -> str:
+        """
+        Describe the instances a relation refers to, without their own relations. The description only depends on the
+        model and not on the instances that were named before.
+        """
+        try:
+            value = slot.value
+        except Exception:
+            return "?"
+
+        values = value if isinstance(value, list) else [value]
+        in_progress, describing = self._in_progress, self._describing
+        self._in_progress, self._describing = {instance}, True
+        try:
+            return "[%s]" % ",".join(
+                sorted(self._compute(v, related=False) if self._is_instance(v) else repr(v) for v in values)
+            )
+        finally:
+            self._in_progress, self._describing = in_progress, describing
+
+    @staticmethod
+    def _is_instance(value: object) -> bool:
+        return hasattr(value, "slots") and hasattr(value, "type")
+
+    def _primitive(self, value: object) -> str:
+        if self._is_instance(value):
+            if value in self._in_progress:
+                # break cycles in the index definitions
+                return value.type.get_full_name()
+            if self._describing:
+                return self._compute(value, related=False)
+            return self.get(value)
+        return repr(value)
+
+
+# an entity type selector: /regex/, subclasses-of(ns::Type), ns::*, ns::** or the full name of a type
+SELECTOR = r"/(?:[^/\\]|\\.)+/|subclasses-of\([^)\s]+\)"
+# the options of a line between square brackets, double quoted values can contain any character except a double quote
+OPTIONS = r'(\[(?P<options>(?:"[^"]*"|[^\]"])*)\])?'
+# the relation path of a relation line, the steps are separated with dots that are not between double quotes
+RELATIONS = r'(?P<relations>(?:\.(?:"[^"]*"|[^\["])+)+)'
+SUBCLASSES_RE = re.compile(r"^subclasses-of\((?P<entity>[^)\s]+)\)$")
+
+
+def parse_selector(selector: str) -> None:
+    """
+    Validate an entity type selector
+
+    :raises ParseException: The selector is not valid
+    """
+    if len(selector) > 1 and selector[0] == "/" and selector[-1] == "/":
+        try:
+            re.compile(selector[1:-1])
+        except re.error:
+            raise ParseException()
+
+
+class TypeIndex(object):
+    """
+    An index of the entity types of the model on their namespace and name, used to resolve the type selectors of the
+    graph filters. It is built once per export and caches every resolved selector.
+    """
+
+    def __init__(self, types: "Dict[str, object]") -> None:
+        self.entities: "Dict[str, Entity]" = {name: t for name, t in types.items() if isinstance(t, Entity)}
+        self.namespaces: "Dict[str, List[str]]" = {}
+        for name in sorted(self.entities):
+            self.namespaces.setdefault(name.rsplit("::", 1)[0], []).append(name)
+        self._resolved: "Dict[str, List[str]]" = {}
+        self._selects: "Dict[Tuple[str, Entity], bool]" = {}
+
+    def resolve(self, selector: str) -> "List[str]":
+        """
+        Resolve a selector to the names of the entity types it selects.
+
+        The instances of a type include the instances of its subtypes, so a type is left out when one of its parents
+        is selected as well. This way every instance is only scanned once for a selector.
+        """
+        resolved = self._resolved.get(selector)
+        if resolved is None:
+            resolved = self._minimize(self._select(selector))
+            self._resolved[selector] = resolved
+        return resolved
+
+    def _select(self, selector: str) -> "List[str]":
+        if len(selector) > 1 and selector[0] == "/" and selector[-1] == "/":
+            regex = re.compile(selector[1:-1])
+            return [name for name in self.entities if regex.fullmatch(name)]
+
+        match = SUBCLASSES_RE.match(selector)
+        if match:
+            entity = self.entities.get(match.group("entity"))
+            if entity is None:
+                return []
+            return [child.get_full_name() for child in entity.get_all_child_entities()]
+
+        namespace, _, name = selector.rpartition("::")
+        if name == "*":
+            return list(self.namespaces.get(namespace, []))
+        if name == "**":
+            return [
+                name
+                for ns, names in self.namespaces.items()
+                if ns == namespace or ns.startswith(namespace + "::")
+                for name in names
+            ]
+
+        if selector in self.entities:
+            return [selector]
+        return []
+
+    def selects(self, selector: str, entity: "Entity") -> bool:
+        """
+        Does the selector select the instances of the given entity type, either directly or through one of its parents
+        """
+        key = (selector, entity)
+        selected = self._selects.get(key)
+        if selected is None:
+            resolved = set(self.resolve(selector))
+            selected = entity.get_full_name() in resolved or any(
+                parent.get_full_name() in resolved for parent in entity.get_all_parent_entities()
+            )
+            self._selects[key] = selected
+        return selected
+
+    def _minimize(self, names: "List[str]") -> "List[str]":
+        selected = set(names)
+        return sorted(
+            name
+            for name in selected
+            if not any(parent.get_full_name() in selected for parent in self.entities[name].get_all_parent_entities())
+        )
+
+
+class LabelTemplate(object):
+    """
+    A label string with formatters between curly braces, parsed once when the filter is compiled
+    """
+
+    def __init__(self, template: str) -> None:
+        self.template = template
+        self.parts = list(string.Formatter().parse(template))
+        # when all formatters are plain attribute names, the label is joined without calling format_map
+        self.simple = all(
+            field is None or (field.isidentifier() and not spec and conversion is None)
+            for _, field, spec, conversion in self.parts
+        )
+
+    def format(self, attributes: "Mapping[str, object]") -> str:
+        if not self.simple:
+            return self.template.format_map(attributes)
+        return "".join(literal if field is None else literal + str(attributes[field]) for literal, field, _, _ in self.parts)
 
 
 class Config(object):
     """
     Diagram configuration
+
+    A line selects the instances of self.entity. It is evaluated in two steps: match is called for every instance during
+    the scan of the instances and apply adds the matched instances to the graph of a diagram. A line does not depend on
+    the diagram, so a compiled filter can be shared by all diagrams with the same filter.
     """
 
-    def __init__(self, collector, line):
-        self.collector = collector
+    def __init__(self, line, lineno=None):
+        self.lineno = lineno
+        self.line = line
+        # the predicates of the where options, an instance is only selected when it satisfies all of them
+        self.where: "List[Predicate]" = []
         self.parse_line(line)
 
     def parse_line(self, line):
         raise NotImplementedError()
 
+    def match(self, instance, attributes: AttributeCache):
+        """
+        Evaluate this line for the given instance of self.entity
+
+        :return: The result to pass to apply or None when the instance is not selected by this line
+        """
+        raise NotImplementedError()
+
+    def apply(self, collector: "GraphCollector", instance, result) -> None:
+        """
+        Add a matched instance to the graph
+        """
+        raise NotImplementedError()
+
+    def collect(self, collector: "GraphCollector", scope, attributes: "Optional[AttributeCache]" = None):
+        if attributes is None:
+            attributes = AttributeCache()
+
+        for entity in TypeIndex(scope).resolve(self.entity):
+            for instance in scope[entity].get_all_instances():
+                result = self.match(instance, attributes)
+                if result is not None:
+                    self.apply(collector, instance, result)
+
     def _parse_options(self, options_string):
-        opt_list = OPT_RE.findall(options_string)
-        return {key: value for _, key, value in opt_list}
+        options = {}
+        for item in OPT_ITEM_RE.findall(options_string):
+            item = item.strip()
+            if item.startswith("where "):
+                self.where.extend(parse_where(item[len("where ") :]))
+                continue
+            options.update({key: value for _, key, value in OPT_RE.findall(item)})
+        return options
+
+    def satisfies(self, instance, attributes: AttributeCache) -> bool:
+        """
+        Evaluate the where predicates of this line, before anything is built for the instance
+        """
+        if not self.where:
+            return True
+        instance_attributes = attributes.get(instance)
+        return all(predicate(instance_attributes) for predicate in self.where)
 
 
 class EntityConfig(Config):
@@ -58,13 +554,16 @@ class EntityConfig(Config):
     Entity instance configuration
     """
 
-    re = re.compile(r"^(?P<entity>[^:]+::[^.\[]+)(\[(?P<options>([^,\]]+,?)*)\])?$")
+    re = re.compile(r"^(?P<entity>" + SELECTOR + r"|[^:]+::[^.\[]+)" + OPTIONS + "$")
 
-    def __init__(self, collector, line):
+    def __init__(self, line, lineno=None):
         self.entity = None
         self.options = {}
         self.container = False
-        Config.__init__(self, collector, line)
+        self.label = None
+        self.template = None
+        self.aggregate = None
+        Config.__init__(self, line, lineno)
 
     def parse_line(self, line):
         match = EntityConfig.re.search(line)
@@ -73,6 +572,7 @@ class EntityConfig(Config):
 
         matches = match.groupdict()
         self.entity = matches["entity"]
+        parse_selector(self.entity)
 
         if "options" in matches and matches["options"]:
             self.options = self._parse_options(matches["options"])
@@ -81,30 +581,36 @@ class EntityConfig(Config):
         self.label = self.options.get("label", None)
         if "label" in self.options:
             del self.options["label"]
+        if self.label is not None and len(self.label) > 1 and self.label[0] == '"' and self.label[-1] == '"':
+            self.template = LabelTemplate(self.label[1:-1])
+        self.aggregate = self.options.pop("aggregate", None)
 
-    def collect(self, scope):
-        if self.entity not in scope:
-            return
+    def match(self, instance, attributes: AttributeCache):
+        if not self.satisfies(instance, attributes):
+            return None
 
-        instances = scope[self.entity].get_all_instances()
+        options = dict(self.options)
+        instance_attributes = attributes.get(instance)
 
-        for instance in instances:
-            options = dict(self.options)
-            attributes = {k: v.value for k, v in instance.slots.items()}
+        if self.label is not None:
+            if self.label in instance_attributes:
+                options["label"] = instance_attributes[self.label]
+            elif self.template is not None:
+                options["label"] = self.template.format(instance_attributes)
 
-            if self.label is not None:
-                if self.label in attributes:
-                    options["label"] = attributes[self.label]
-                elif self.label[0] == '"' and self.label[-1] == '"':
-                    options["label"] = self.label[1:-1].format_map(attributes)
+        elif "name" in instance_attributes:
+            options["label"] = instance_attributes["name"]
 
-            elif "name" in attributes:
-                options["label"] = attributes["name"]
+        # without a label the node is labelled with its name, which is derived from the model
 
-            else:
-                options["label"] = repr(instance)
+        group = group_of(instance, instance_attributes, self.aggregate) if self.aggregate else None
+        return options, group
 
-            self.collector.add_node(Node(instance, subgraph=self.container, **options))
+    def apply(self, collector: "GraphCollector", instance, result) -> None:
+        options, group = result
+        node = collector.add_node(instance, subgraph=self.container, **options)
+        if group is not None:
+            collector.groups[node] = group
 
     def __repr__(self):
         return self.entity + " -> " + ", ".join(["%s=%s" % x for x in self.options.items()])
@@ -115,14 +621,15 @@ class RelationConfig(Config):
     Instance relation configuration
     """
 
-    re = re.compile(r"^(?P<entity>[^:]+::[^.]+)(?P<relations>(\.[^\[]+)+)(\[(?P<options>([^,\]]+,?)*)\])?")
+    re = re.compile(r"^(?P<entity>" + SELECTOR + r"|[^:]+::[^.]+)" + RELATIONS + OPTIONS)
 
-    def __init__(self, collector, line):
+    def __init__(self, line, lineno=None):
         self.entity = None
         self.options = {}
         self.relation = []
         self.type = None
-        Config.__init__(self, collector, line)
+        self.fanout = None
+        Config.__init__(self, line, lineno)
 
     def parse_line(self, line):
         match = RelationConfig.re.search(line)
@@ -132,195 +639,457 @@ class RelationConfig(Config):
 
         matches = match.groupdict()
         self.entity = matches["entity"]
+        parse_selector(self.entity)
 
         if "options" in matches and matches["options"]:
             self.options = self._parse_options(matches["options"])
 
-        self.relation = [x for x in matches["relations"].split(".") if x]
+        self.relation = [x for x in re.findall(r'(?:"[^"]*"|[^."])+', matches["relations"])]
+        for hop in self.relation:
+            parse_hop(hop)
         self.type = self.options.get("type", None)
+        if "fanout" in self.options:
+            try:
+                self.fanout = int(self.options.pop("fanout"))
+            except ValueError:
+                raise ParseException()
 
-    def collect_targets(self, instance, paths):
+    def collect_targets(self, instance, paths, attributes: AttributeCache):
         """
-        Collect the list of targets given the instance and the path list
+        Collect the targets given the instance and the path list. Every target is returned only once.
+
+        The result is memoized on the instance and the remaining path, so a path suffix that is reached from many
+        instances, or from the same instance through different routes, is only walked once.
         """
         if instance is None:
-            return []
-        attributes = {k: v.value for k, v in instance.slots.items()}
-        targets = []
+            return ()
         if not paths:
-            return [instance]
+            return (instance,)
 
-        path = paths[0]
-        if path not in attributes:
+        paths = tuple(paths)
+        key = (instance, paths, self.fanout)
+        targets = attributes.targets.get(key)
+        if targets is not None:
             return targets
 
-        values = attributes[path]
-        if isinstance(values, list):
-            for value in values:
-                targets.extend(self.collect_targets(value, paths[1:]))
+        hop = parse_hop(paths[0])
+        instance_attributes = attributes.get(instance)
+        if hop.name not in instance_attributes:
+            targets = ()
         else:
-            targets.extend(self.collect_targets(values, paths[1:]))
+            values = instance_attributes[hop.name]
+            if not isinstance(values, list):
+                values = [values]
+            if hop.filtered:
+                values = [value for value in values if hop.accepts(value, attributes)]
+            if self.fanout is not None and len(values) > self.fanout:
+                values = values[: self.fanout]
+
+            # dicts keep insertion order, so this deduplicates the targets in a deterministic order
+            unique = {}
+            for value in values:
+                for target in self.collect_targets(value, paths[1:], attributes):
+                    unique[target] = None
+            targets = tuple(unique)
 
+        attributes.targets[key] = targets
         return targets
 
-    def collect(self, scope):
-        if self.entity not in scope:
-            return
-
-        instances = scope[self.entity].get_all_instances()
-
-        for instance in instances:
-            targets = self.collect_targets(instance, self.relation)
+    def match(self, instance, attributes: AttributeCache):
+        if not self.satisfies(instance, attributes):
+            return None
+        targets = self.collect_targets(instance, self.relation, attributes)
+        if not targets:
+            return None
+        return targets
 
-            for target in targets:
-                if self.type == "contained_in":
-                    target_node = self.collector.get_or_add(target)
-                    from_node = self.collector.get_or_add(instance)
-                    target_node.add_child(from_node)
-                elif self.type == "contained_by":
-                    target_node = self.collector.get_or_add(target)
-                    from_node = self.collector.get_or_add(instance)
-                    from_node.add_child(target_node)
-                else:
-                    self.collector.add_relation(instance, target, **self.options)
+    def apply(self, collector: "GraphCollector", instance, result) -> None:
+        for target in result:
+            if self.type == "contained_in":
+                target_node = collector.get_or_add(target)
+                from_node = collector.get_or_add(instance)
+                collector.add_child(target_node, from_node)
+            elif self.type == "contained_by":
+                target_node = collector.get_or_add(target)
+                from_node = collector.get_or_add(instance)
+                collector.add_child(from_node, target_node)
+            else:
+                collector.add_relation(instance, target, **self.options)
 
     def __repr__(self):
         return self.entity + " -> " + repr(self.relation) + " -> " + ", ".join(["%s=%s" % x for x in self.options.items()])
 
 
+class FocusConfig(Config):
+    """
+    The root instances of a focused diagram: an entity type selector with optional attribute values, for example
+    std::Host[name=vm1]
+    """
+
+    def __init__(self, line, lineno=None):
+        self.entity = None
+        self.options = {}
+        Config.__init__(self, line, lineno)
+
+    def parse_line(self, line):
+        match = EntityConfig.re.search(line)
+        if not match:
+            raise ParseException()
+
+        matches = match.groupdict()
+        self.entity = matches["entity"]
+        parse_selector(self.entity)
+
+        if matches["options"]:
+            self.options = {name: unquote(value) for name, value in self._parse_options(matches["options"]).items()}
+        # the attribute values are compared like the predicates of a where option
+        self.where.extend(Predicate('%s="%s"' % (name.strip(), value)) for name, value in self.options.items())
+
+    def match(self, instance, attributes: AttributeCache):
+        if not self.satisfies(instance, attributes):
+            return None
+        return instance
+
+    def apply(self, collector: "GraphCollector", instance, result) -> None:
+        collector.get_or_add(instance)
+
+
 PARSERS = [EntityConfig, RelationConfig]
 
 
-def parse_config_line(collector, line):
+def parse_config_line(line, lineno=None):
     for parser in PARSERS:
         try:
-            return parser(collector, line)
+            return parser(line, lineno)
         except ParseException:
             pass
 
 
-class Node(object):
+class FilterSyntaxException(ParseException):
     """
-    A graphviz node
+    A graph filter contains lines that can not be parsed
     """
 
-    def __init__(self, node_id, subgraph=False, **props):
-        self.node_id = node_id
-        self.props = props
-        self.subgraph = subgraph
-        self.children = []
+    def __init__(self, errors: "List[Tuple[int, str]]") -> None:
+        self.errors = errors
+        ParseException.__init__(self, "\n".join("line %d: invalid filter line %r" % error for error in errors))
 
-    def add_child(self, child):
-        """
-        Add a child. This will automatically convert this node to a subgraph
-        """
-        self.subgraph = True
-        self.children.append(child)
 
-    def to_dot(self) -> "List[str]":
-        if not self.subgraph:
-            options = ",".join(['%s="%s"' % x for x in self.props.items()])
-            return ['"%s" [%s];' % (self, options)]
-        else:
-            node_strings = ["subgraph cluster_{0} {{".format(self)]
-            node_strings += ['  {key}="{value}"'.format(key=k, value=v) for k, v in self.props.items()]
-            node_strings += ['  "{0}";'.format(str(child)) for child in self.children]
-            node_strings += ["}"]
+class GraphFilter(object):
+    """
+    A compiled graph filter: the parsed lines in the order they are applied, grouped by the entity type they scan
+    """
 
-            return node_strings
+    def __init__(self, lines: "List[Config]") -> None:
+        self.lines = lines
+        self.entities: "Dict[str, List[Config]]" = {}
+        for line in lines:
+            self.entities.setdefault(line.entity, []).append(line)
 
-    def get_id(self):
-        if not self.subgraph:
-            return str(self)
-        else:
-            return f"cluster_{ str(self)}"
 
-    def __str__(self):
-        return str(id(self.node_id))
+def check_predicates(graph_filter: GraphFilter, index: TypeIndex) -> None:
+    """
+    Check that the predicates of a filter do not compare a relation, the instances of a relation can not be compared
+    with a value
 
-    def merge_node(self, other):
-        """
-        Merge the settings of the given node
-        """
-        self.props.update(other.props)
-        self.subgraph = other.subgraph
-        self.children.extend(other.children)
+    :raises FilterSyntaxException: The filter contains lines with a predicate on a relation
+    """
 
+    def compares_relation(entities: "List[Entity]", predicates: "List[Predicate]") -> bool:
+        return any(
+            isinstance(candidate.get_attribute(predicate.attribute), RelationAttribute)
+            for entity in entities
+            for candidate in [entity] + list(entity.get_all_child_entities())
+            for predicate in predicates
+        )
+
+    errors = []
+    for line in graph_filter.lines:
+        entities = [index.entities[name] for name in index.resolve(line.entity)]
+        invalid = compares_relation(entities, line.where)
+        for text in line.relation if isinstance(line, RelationConfig) else []:
+            hop = parse_hop(text)
+            if hop.types:
+                entities = [index.entities[name] for name in hop.types if name in index.entities]
+            else:
+                attributes = [
+                    candidate.get_attribute(hop.name)
+                    for entity in entities
+                    for candidate in [entity] + list(entity.get_all_child_entities())
+                ]
+                entities = list({a.get_type(): None for a in attributes if isinstance(a, RelationAttribute)})
+            invalid = invalid or compares_relation(entities, hop.predicates)
+        if invalid:
+            errors.append((line.lineno, line.line))
 
-class Relation(object):
-    """
-    A graphviz edge between two nodes
-    """
+    if errors:
+        raise FilterSyntaxException(errors)
 
-    def __init__(self, relation_id, from_node, to_node, **props):
-        self.relation_id = relation_id
-        self.from_node = from_node
-        self.to_node = to_node
-        self.props = props
 
-    def to_dot(self):
-        from_id = self.from_node.get_id()
-        to_id = self.to_node.get_id()
+# compiled filters by the hash of their content
+_compiled_filters: "Dict[str, GraphFilter]" = {}
 
-        if self.from_node.subgraph and self.from_node.children:
-            self.props["ltail"] = from_id
-            # select random one of the children, otherwise graphviz complains
-            from_id = str(self.from_node.children[0])
 
-        if self.to_node.subgraph and self.to_node.children:
-            self.props["lhead"] = to_id
-            # select random one of the children, otherwise graphviz complains
-            to_id = str(self.to_node.children[0])
+def compile_filter(diagram_config: str) -> GraphFilter:
+    """
+    Compile a graph filter. Filters are cached on their content, so an identical filter is only parsed once.
 
-        options = ",".join(['%s="%s"' % x for x in self.props.items() if x[1] is not None])
-        if not options:
-            return '"%s" -- "%s";\n' % (from_id, to_id)
+    :raises FilterSyntaxException: The filter contains lines that can not be parsed
+    """
+    key = hashlib.sha256(diagram_config.encode()).hexdigest()
+    if key in _compiled_filters:
+        return _compiled_filters[key]
+
+    lines = []
+    errors = []
+    for lineno, line in enumerate(diagram_config.split("\n"), start=1):
+        line = line.strip()
+        if not line or line[0] == "#":
+            continue
+
+        config_line = parse_config_line(line, lineno)
+        if config_line is None:
+            errors.append((lineno, line))
         else:
-            return '"%s" -- "%s" [%s];\n' % (from_id, to_id, options)
+            lines.append(config_line)
+
+    if errors:
+        raise FilterSyntaxException(errors)
+
+    graph_filter = GraphFilter(lines)
+    _compiled_filters[key] = graph_filter
+    return graph_filter
+
+
+# marks a node without a label
+NO_LABEL = object()
 
 
 class GraphCollector(object):
-    def __init__(self):
-        self.relations = dict()
+    """
+    A compact store for the nodes and edges of a graph.
+
+    Every node gets an integer id, in the order the nodes are added. The nodes are stored in columns: the instance, the
+    options, the label and whether the node is a subgraph. Option dicts are interned, so all nodes created by the same
+    filter line share a single dict and only the label is stored per node. Children are only stored for containers.
+
+    Edges are stored in two integer arrays with an interned option dict per edge. They are deduplicated on the integer ids
+    of their ends and their label.
+
+    A graph of 1 000 000 edges between 100 000 labelled nodes takes about 160MB in this store, compared to about 540MB
+    with a Node and a Relation object per element (measured with tracemalloc on CPython 3.11).
+    """
+
+    def __init__(self, names: "Optional[NodeNames]" = None):
         self.parents = dict()
-        self.nodes = {}
+        self.names = names if names is not None else NodeNames()
+        # node columns
+        self.ids: "Dict[object, int]" = {}
+        self.instances: "List[object]" = []
+        self.options: "List[Dict[str, object]]" = []
+        self.labels: "List[object]" = []
+        self.subgraph = bytearray()
+        self.children: "Dict[int, List[int]]" = {}
+        # the summary node each node is aggregated into, see aggregate
+        self.groups: "Dict[int, str]" = {}
+        # edge columns
+        self.edge_ids: "Dict[Tuple[int, int, object], int]" = {}
+        self.edge_from = array("i")
+        self.edge_to = array("i")
+        self.edge_options: "List[Dict[str, object]]" = []
+        self._interned: "Dict[Tuple[Tuple[str, object], ...], Dict[str, object]]" = {}
+
+    def intern(self, options: "Dict[str, object]") -> "Dict[str, object]":
+        """
+        Return a shared dict equal to options. The returned dict must not be modified.
+        """
+        key = tuple(options.items())
+        try:
+            return self._interned.setdefault(key, options)
+        except TypeError:
+            # unhashable option values can not be shared
+            return options
+
+    def __len__(self) -> int:
+        return len(self.instances)
+
+    def edge_count(self) -> int:
+        return len(self.edge_from)
 
-    def add_node(self, node: Node) -> None:
-        if node.node_id not in self.nodes:
-            self.nodes[node.node_id] = node
+    def add_node(self, instance, subgraph=False, **props) -> int:
+        """
+        Add a node for the instance or merge the settings into its existing node
+
+        :return: The id of the node
+        """
+        label = props.pop("label", NO_LABEL)
+        node = self.ids.get(instance)
+        if node is None:
+            node = len(self.instances)
+            self.ids[instance] = node
+            self.instances.append(instance)
+            self.options.append(self.intern(props))
+            self.labels.append(label)
+            self.subgraph.append(subgraph)
         else:
-            self.nodes[node.node_id].merge_node(node)
+            if props:
+                self.options[node] = self.intern({**self.options[node], **props})
+            if label is not NO_LABEL:
+                self.labels[node] = label
+            self.subgraph[node] = subgraph
         return node
 
-    def get_node(self, instance: "inmanta.execute.runtime.Instance") -> "Node":
+    def get_node(self, instance: "inmanta.execute.runtime.Instance") -> "Optional[int]":
         """
-        Get the node that represents the given instance
+        Get the id of the node that represents the given instance
         """
-        if instance in self.nodes:
-            return self.nodes[instance]
-        return None
+        return self.ids.get(instance)
 
-    def get_or_add(self, instance: "inmanta.execute.runtime.Instance") -> "Node":
+    def get_or_add(self, instance: "inmanta.execute.runtime.Instance") -> int:
         """
         Get or add a node
         """
-        node = self.get_node(instance)
+        node = self.ids.get(instance)
         if node is None:
-            node = self.add_node(Node(instance))
-
+            node = self.add_node(instance)
         return node
 
+    def add_child(self, parent: int, child: int) -> None:
+        """
+        Add a child. This will automatically convert the parent to a subgraph
+        """
+        self.subgraph[parent] = True
+        self.children.setdefault(parent, []).append(child)
+
     def add_relation(self, from_instance, to_instance, label=None, **kwargs):
         """
         Add relation, overwrite any duplicate with same label and same ends (even if ends are swapped)
+
+        :return: The id of the edge
         """
         from_node = self.get_or_add(from_instance)
         to_node = self.get_or_add(to_instance)
 
-        node_list = sorted([str(from_node), str(to_node)])
-        idx = (node_list[0], node_list[1], label)
+        if from_node < to_node:
+            idx = (from_node, to_node, label)
+        else:
+            idx = (to_node, from_node, label)
+
+        kwargs["label"] = label
+        edge = self.edge_ids.get(idx)
+        if edge is None:
+            edge = len(self.edge_from)
+            self.edge_ids[idx] = edge
+            self.edge_from.append(from_node)
+            self.edge_to.append(to_node)
+            self.edge_options.append(self.intern(kwargs))
+        else:
+            self.edge_from[edge] = from_node
+            self.edge_to[edge] = to_node
+            self.edge_options[edge] = self.intern(kwargs)
+        return edge
+
+    def node_name(self, node: int) -> str:
+        return self.names.get(self.instances[node])
+
+    def sorted_children(self, node: int) -> "List[int]":
+        return sorted(self.children.get(node, ()), key=self.node_name)
+
+    def sorted_nodes(self) -> "List[int]":
+        """
+        All nodes in the order of their names
+        """
+        return sorted(range(len(self.instances)), key=self.node_name)
+
+    def sorted_edges(self) -> "List[int]":
+        """
+        All edges in the order of the names of their ends and their label
+        """
 
-        self.relations[idx] = Relation(idx, from_node, to_node, label=label, **kwargs)
+        def edge_key(edge: int) -> "Tuple[str, str, str]":
+            return (
+                self.node_name(self.edge_from[edge]),
+                self.node_name(self.edge_to[edge]),
+                str(self.edge_options[edge].get("label")),
+            )
+
+        return sorted(range(len(self.edge_from)), key=edge_key)
+
+    def container_of(self) -> "Dict[int, int]":
+        """
+        The container of every node that is placed in one
+        """
+        return {child: parent for parent in sorted(self.children, reverse=True) for child in self.children[parent]}
+
+    def entity_name(self, node: int) -> "Optional[str]":
+        """
+        The entity type of a node, None when the node is not an instance
+        """
+        instance = self.instances[node]
+        return instance.type.get_full_name() if NodeNames._is_instance(instance) else None
+
+    def get_id(self, node: int) -> str:
+        if not self.subgraph[node]:
+            return self.node_name(node)
+        else:
+            return "cluster_%s" % self.node_name(node)
+
+    def node_props(self, node: int) -> "Dict[str, object]":
+        """
+        The graphviz attributes of a node
+        """
+        if self.labels[node] is NO_LABEL:
+            return self.options[node]
+        return {**self.options[node], "label": self.labels[node]}
+
+    def write_node(self, fd: "TextIO", node: int, indent: str = "  ") -> None:
+        """
+        Write the dot statements for a node
+        """
+        props = self.node_props(node)
+        if not self.subgraph[node]:
+            fd.write('%s"%s" [%s];\n' % (indent, self.node_name(node), ",".join(['%s="%s"' % x for x in props.items()])))
+        else:
+            fd.write("%ssubgraph cluster_%s {\n" % (indent, self.node_name(node)))
+            for item in props.items():
+                fd.write('%s  %s="%s"\n' % ((indent,) + item))
+            for child in self.sorted_children(node):
+                fd.write('%s  "%s";\n' % (indent, self.node_name(child)))
+            fd.write("%s}\n" % indent)
+
+    def write_edge(self, fd: "TextIO", edge: int, indent: str = "  ") -> None:
+        """
+        Write the dot statement for an edge
+        """
+        from_id, to_id, props = self.edge_ends(edge)
+        options = ",".join(['%s="%s"' % x for x in props.items() if x[1] is not None])
+        if not options:
+            fd.write('%s"%s" -- "%s";\n' % (indent, from_id, to_id))
+        else:
+            fd.write('%s"%s" -- "%s" [%s];\n' % (indent, from_id, to_id, options))
+
+    def edge_ends(self, edge: int) -> "Tuple[str, str, Dict[str, object]]":
+        """
+        The names of the nodes an edge is drawn between and its graphviz attributes. An edge to a container is drawn to
+        one of its children and clipped at the border of the container.
+        """
+        from_node = self.edge_from[edge]
+        to_node = self.edge_to[edge]
+        from_id = self.get_id(from_node)
+        to_id = self.get_id(to_node)
+        props = self.edge_options[edge]
+
+        if self.subgraph[from_node] and self.children.get(from_node):
+            props = {**props, "ltail": from_id}
+            # select one of the children, otherwise graphviz complains
+            from_id = self.node_name(self.sorted_children(from_node)[0])
+
+        if self.subgraph[to_node] and self.children.get(to_node):
+            props = {**props, "lhead": to_id}
+            # select one of the children, otherwise graphviz complains
+            to_id = self.node_name(self.sorted_children(to_node)[0])
+
+        return from_id, to_id, props
 
     # def add_parent(self, fro, to):
     #     self.parents[(id(fro), id(to))] = (id(fro), id(to))
@@ -349,19 +1118,27 @@ class GraphCollector(object):
     #     self.add_node(Node(id=id(fro), label=fro))
     #     self.add_node(Node(id=id(to), label=to))
 
-    def dump_dot(self):
-        dot = "  compound=true;\n"
+    def write_dot(self, fd: "TextIO") -> None:
+        """
+        Write the body of the graph statement by statement, so the dot text is never held in memory.
+
+        Nodes and edges are written in the order of their names, so the same model always results in the same text.
+        """
+        fd.write("  compound=true;\n")
 
-        dot += "\n".join(["  " + line for node in self.nodes.values() for line in node.to_dot()])
-        dot += "\n"
+        for node in self.sorted_nodes():
+            self.write_node(fd, node)
 
-        for rel in self.relations.values():
-            dot += "  " + rel.to_dot()
+        for edge in self.sorted_edges():
+            self.write_edge(fd, edge)
 
         for rel in self.parents:
-            dot += '"%s" -- "%s" [dir=forward];\n' % (rel[0], rel[1])
+            fd.write('"%s" -- "%s" [dir=forward];\n' % (rel[0], rel[1]))
 
-        return dot
+    def dump_dot(self) -> str:
+        dot = io.StringIO()
+        self.write_dot(dot)
+        return dot.getvalue()
 
     # def dump_plant_uml(self):
     #     dot = ""
@@ -387,6 +1164,430 @@ class GraphCollector(object):
     #     return dot
 
 
+def group_of(instance, attributes: "Mapping[str, object]", by: str) -> "Optional[str]":
+    """
+    The group of an instance when aggregating by entity type (by="type") or by the value of an attribute
+
+    :return: The title of the group or None when the instance does not have the attribute
+    """
+    type_name = instance.type.get_full_name()
+    if by == "type":
+        return type_name
+    if by not in attributes:
+        return None
+
+    try:
+        value = attributes[by]
+    except Exception:
+        # optional attributes without a value
+        return None
+    return "%s %s=%s" % (type_name, by, group_key(value))
+
+
+def group_key(value: object) -> str:
+    """
+    The part of a group title for an attribute value. A related instance is represented by its name attribute when it
+    has one and by its node name otherwise, so the title does not depend on the memory address of the instance.
+    """
+    if isinstance(value, list):
+        return "[%s]" % ", ".join(sorted(group_key(v) for v in value))
+    if NodeNames._is_instance(value):
+        attributes = InstanceAttributes(value)
+        if "name" in attributes:
+            try:
+                return literal(attributes["name"])
+            except Exception:
+                pass
+        return NodeNames()._compute(value)
+    return literal(value)
+
+
+def summary_title(group: object, size: int) -> str:
+    return "%s (%d)" % (group, size)
+
+
+def aggregate(
+    collector: GraphCollector,
+    group: "Optional[Callable[[int], Optional[object]]]" = None,
+    title: "Optional[Callable[[object, int], str]]" = None,
+) -> GraphCollector:
+    """
+    Collapse the nodes of a graph into one summary node per group, labelled with the number of nodes in the group. All
+    edges between the nodes of two groups become a single edge, labelled with the number of edges it replaces.
+
+    :param group: The group of a node or None to keep the node. Defaults to the groups set by the aggregate option of
+        the filter lines.
+    :param title: The label of the summary node of a group, given the group and its size
+    """
+    if group is None:
+        group = collector.groups.get
+    if title is None:
+        title = summary_title
+
+    groups = [group(node) for node in range(len(collector))]
+    sizes = Counter(key for key in groups if key is not None)
+
+    result = GraphCollector(collector.names)
+    keys = []
+    for node, key in enumerate(groups):
+        if key is None:
+            key = collector.instances[node]
+            result.add_node(key, subgraph=bool(collector.subgraph[node]), **collector.node_props(node))
+        elif key not in result.ids:
+            result.add_node(key, **{**collector.options[node], "label": title(key, sizes[key])})
+        keys.append(key)
+
+    # a summary node can only be placed in a single container
+    placed = set()
+    for parent, children in collector.children.items():
+        parent_node = result.ids[keys[parent]]
+        for child in children:
+            child_node = result.ids[keys[child]]
+            if child_node == parent_node or (parent_node, child_node) in placed:
+                continue
+            if groups[child] is not None and child_node in placed:
+                continue
+            placed.add((parent_node, child_node))
+            placed.add(child_node)
+            result.add_child(parent_node, child_node)
+
+    weights = Counter()
+    for edge in range(collector.edge_count()):
+        edge_id = result.add_relation(
+            keys[collector.edge_from[edge]], keys[collector.edge_to[edge]], **collector.edge_options[edge]
+        )
+        weights[edge_id] += 1
+
+    for edge, weight in weights.items():
+        if weight > 1:
+            options = result.edge_options[edge]
+            label = "%s (%d)" % (options["label"], weight) if options.get("label") is not None else str(weight)
+            result.edge_options[edge] = result.intern({**options, "label": label, "weight": weight})
+
+    return result
+
+
+def fold_hubs(
+    name: str, collector: GraphCollector, degree: int, keep: int = 0, keep_pattern: "Optional[str]" = None
+) -> "Tuple[GraphCollector, Dict[str, int]]":
+    """
+    Fold the leaf neighbours of high degree nodes (hubs) into a single "+N <type>" node per hub and entity type. A leaf
+    has a single edge and is not a container or inside one, the edges of a hub to its leaves are nearly identical and
+    make the layout slow.
+
+    :param degree: Nodes with more edges than this are hubs
+    :param keep: The number of leaves of each type that is not folded, they are selected in the order of their label
+    :param keep_pattern: Only keep leaves with a label that matches this regular expression
+    :return: The folded graph and the number of folded leaves of each hub, by the label of the hub
+    """
+    degrees = Counter(collector.edge_from)
+    degrees.update(collector.edge_to)
+    hubs = [node for node, count in degrees.items() if count > degree]
+    if not hubs:
+        return collector, {}
+
+    contained = {child for children in collector.children.values() for child in children}
+
+    def is_leaf(node: int) -> bool:
+        return (
+            degrees[node] == 1
+            and not collector.subgraph[node]
+            and node not in collector.children
+            and node not in contained
+            and NodeNames._is_instance(collector.instances[node])
+        )
+
+    neighbours: "Dict[int, List[int]]" = {hub: [] for hub in hubs}
+    for edge in range(collector.edge_count()):
+        from_node, to_node = collector.edge_from[edge], collector.edge_to[edge]
+        if from_node in neighbours and is_leaf(to_node):
+            neighbours[from_node].append(to_node)
+        elif to_node in neighbours and is_leaf(from_node):
+            neighbours[to_node].append(from_node)
+
+    pattern = re.compile(keep_pattern) if keep_pattern else None
+    groups: "Dict[int, Tuple[str, str]]" = {}
+    folded: "Dict[str, int]" = {}
+    for hub in sorted(hubs, key=collector.node_name):
+        by_type: "Dict[str, List[int]]" = {}
+        for leaf in neighbours[hub]:
+            by_type.setdefault(collector.instances[leaf].type.get_full_name(), []).append(leaf)
+
+        for type_name, leaves in by_type.items():
+            leaves.sort(key=lambda node: (str(collector.labels[node]), collector.node_name(node)))
+            if keep:
+                kept = [leaf for leaf in leaves if pattern is None or pattern.search(str(collector.labels[leaf]))][:keep]
+                leaves = [leaf for leaf in leaves if leaf not in kept]
+            if len(leaves) < 2:
+                continue
+            for leaf in leaves:
+                groups[leaf] = (collector.node_name(hub), type_name)
+            label = collector.labels[hub]
+            label = collector.node_name(hub) if label is NO_LABEL else str(label)
+            folded[label] = folded.get(label, 0) + len(leaves)
+
+    if not folded:
+        return collector, {}
+
+    for label, count in sorted(folded.items()):
+        LOGGER.info("Graph %s: folded %d leaf neighbours of hub %s", name, count, label)
+    return aggregate(collector, groups.get, lambda group, size: "+%d %s" % (size, group[1])), folded
+
+
+def reduce_graph(
+    name: str,
+    collector: GraphCollector,
+    by: str,
+    max_nodes: int,
+    max_edges: int,
+    fold_degree: int = 0,
+    fold_keep: int = 0,
+    fold_pattern: "Optional[str]" = None,
+) -> GraphCollector:
+    """
+    Aggregate the graph as configured by its filter lines and by the aggregate attribute of the graph. When the graph is
+    still larger than the node or edge budget, all remaining instances are aggregated by entity type.
+
+    :param by: Aggregate all instances by "type" or by an attribute, an empty string to only apply the filter lines
+    :param max_nodes: The maximal number of nodes, 0 for no limit
+    :param max_edges: The maximal number of edges, 0 for no limit
+    :param fold_degree: Fold the leaves of nodes with more edges than this, see fold_hubs, 0 to not fold
+    """
+    if by:
+        for node, instance in enumerate(collector.instances):
+            if node not in collector.groups and NodeNames._is_instance(instance):
+                key = group_of(instance, InstanceAttributes(instance), by)
+                if key is not None:
+                    collector.groups[node] = key
+
+    if collector.groups:
+        collector = aggregate(collector)
+
+    if fold_degree:
+        collector, _ = fold_hubs(name, collector, fold_degree, fold_keep, fold_pattern)
+
+    if (max_nodes and len(collector) > max_nodes) or (max_edges and collector.edge_count() > max_edges):
+        LOGGER.warning(
+            "Graph %s has %d nodes and %d edges, which is more than the budget of %d nodes and %d edges. "
+            "Its instances are aggregated by entity type.",
+            name,
+            len(collector),
+            collector.edge_count(),
+            max_nodes,
+            max_edges,
+        )
+        collector = aggregate(
+            collector,
+            lambda node: (
+                collector.instances[node].type.get_full_name() if NodeNames._is_instance(collector.instances[node]) else None
+            ),
+        )
+
+    return collector
+
+
+class Page(object):
+    """
+    A part of a paged graph: a top-level container with everything inside it, or the nodes outside of all containers
+    """
+
+    def __init__(self, name: str, title: str, collector: GraphCollector) -> None:
+        self.name = name
+        self.title = title
+        self.collector = collector
+
+    def url(self, file_type: str) -> str:
+        return "%s.%s" % (self.name, file_type)
+
+
+def partition(name: str, collector: GraphCollector, file_type: str) -> "Tuple[List[Page], GraphCollector]":
+    """
+    Split a graph along its top-level containers, so every part can be laid out on its own. The nodes outside of all
+    containers form one more page. An edge between two pages is drawn in both pages as an edge to a stub node that
+    names the other page. A node in containers on two pages is placed on one of them, the other container is linked to a
+    stub of that page.
+
+    :param file_type: The file type the overview links to
+    :return: The pages, named <name>-<n>, and an overview graph with a node per page, linked to the page by its URL
+    """
+    contained = {child for children in collector.children.values() for child in children}
+    roots = sorted((node for node in collector.children if node not in contained), key=collector.node_name)
+
+    page_of = [-1] * len(collector)
+    for page, root in enumerate(roots):
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            if page_of[node] != -1:
+                continue
+            page_of[node] = page
+            stack.extend(collector.children.get(node, []))
+
+    titles = []
+    for root in roots:
+        label = collector.labels[root]
+        titles.append(collector.node_name(root) if label is NO_LABEL else str(label))
+    if -1 in page_of:
+        page_of = [len(roots) if page == -1 else page for page in page_of]
+        titles.append("other")
+
+    pages = [Page("%s-%d" % (name, number + 1), title, GraphCollector(collector.names)) for number, title in enumerate(titles)]
+    for node, page in enumerate(page_of):
+        pages[page].collector.add_node(
+            collector.instances[node], subgraph=bool(collector.subgraph[node]), **collector.node_props(node)
+        )
+
+    def stub(page: int, other: int) -> "Tuple[str, str]":
+        stub = ("page", pages[other].name)
+        pages[page].collector.add_node(stub, shape="note", style="dashed", label="-> %s" % pages[other].title)
+        return stub
+
+    crossing = Counter()
+    for parent, children in collector.children.items():
+        page = pages[page_of[parent]].collector
+        for child in children:
+            if page_of[child] == page_of[parent]:
+                page.add_child(page.get_node(collector.instances[parent]), page.get_node(collector.instances[child]))
+                continue
+            crossing[(min(page_of[parent], page_of[child]), max(page_of[parent], page_of[child]))] += 1
+            page.add_relation(collector.instances[parent], stub(page_of[parent], page_of[child]), style="dashed")
+
+    for edge in range(collector.edge_count()):
+        from_node, to_node = collector.edge_from[edge], collector.edge_to[edge]
+        from_page, to_page = page_of[from_node], page_of[to_node]
+        options = collector.edge_options[edge]
+        if from_page == to_page:
+            pages[from_page].collector.add_relation(collector.instances[from_node], collector.instances[to_node], **options)
+            continue
+        crossing[(min(from_page, to_page), max(from_page, to_page))] += 1
+        for page, node, other in [(from_page, from_node, to_page), (to_page, to_node, from_page)]:
+            pages[page].collector.add_relation(collector.instances[node], stub(page, other), **options)
+
+    overview = GraphCollector(collector.names)
+    for page in pages:
+        overview.add_node(page.name, shape="box", label="%s (%d)" % (page.title, len(page.collector)), URL=page.url(file_type))
+    for (from_page, to_page), count in sorted(crossing.items()):
+        label = {"label": str(count)} if count > 1 else {}
+        overview.add_relation(pages[from_page].name, pages[to_page].name, **label)
+    return pages, overview
+
+
+def write_index(name: str, pages: "List[Page]", file_type: str, fd: "TextIO") -> None:
+    """
+    Write an html page that shows the overview of a paged graph and links to all its pages
+    """
+    fd.write(
+        '<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n<title>%s</title>\n</head>\n<body>\n' % html.escape(name)
+    )
+    fd.write("<h1>%s</h1>\n" % html.escape(name))
+    if file_type in ("png", "svg", "jpg", "gif"):
+        fd.write('<p><img src="%s.%s" alt="overview"></p>\n' % (html.escape(name), file_type))
+    fd.write("<ul>\n")
+    for page in pages:
+        fd.write(
+            '<li><a href="%s">%s</a> (%d nodes)</li>\n'
+            % (html.escape(page.url(file_type)), html.escape(page.title), len(page.collector))
+        )
+    fd.write("</ul>\n</body>\n</html>\n")
+
+
+# the colors of the nodes and edges in a delta graph, by change type
+DELTA_COLORS = {"added": "palegreen", "removed": "lightcoral", "modified": "orange", "context": "gray90"}
+
+
+def snapshot(collector: GraphCollector) -> "Dict[str, object]":
+    """
+    A compact, json serializable summary of a graph: the label and a digest of the attributes and container of every
+    node, by node name, and the ends and label of every edge
+    """
+    containers = collector.container_of()
+    nodes = {}
+    for node in range(len(collector)):
+        props = collector.node_props(node)
+        container = collector.node_name(containers[node]) if node in containers else ""
+        digest = hashlib.sha1(repr((sorted((k, str(v)) for k, v in props.items()), container)).encode()).hexdigest()
+        nodes[collector.node_name(node)] = [str(props.get("label", "")), digest[:12]]
+    edges = sorted(
+        [
+            collector.node_name(collector.edge_from[edge]),
+            collector.node_name(collector.edge_to[edge]),
+            str(collector.edge_options[edge].get("label", "")),
+        ]
+        for edge in range(collector.edge_count())
+    )
+    return {"nodes": nodes, "edges": edges}
+
+
+def delta_graph(collector: GraphCollector, current: "Dict[str, object]", previous: "Dict[str, object]") -> GraphCollector:
+    """
+    A graph of the changes between two snapshots of a graph: the added, removed and modified nodes and edges, colored by
+    change type, and the nodes one hop away from a changed node as context. Its size depends on the size of the change,
+    not on the size of the graph.
+
+    :param collector: The current graph
+    :param current: The snapshot of the current graph
+    :param previous: The snapshot of the previous export of the graph
+    """
+    nodes, old_nodes = current["nodes"], previous["nodes"]
+    edges = {tuple(edge) for edge in current["edges"]}
+    old_edges = {tuple(edge) for edge in previous["edges"]}
+
+    change = {}
+    for name, (_, digest) in nodes.items():
+        if name not in old_nodes:
+            change[name] = "added"
+        elif old_nodes[name][1] != digest:
+            change[name] = "modified"
+    for name in old_nodes:
+        if name not in nodes:
+            change[name] = "removed"
+
+    node_of = {collector.node_name(node): node for node in range(len(collector))}
+    delta = GraphCollector(collector.names)
+
+    def add(name: str, change_type: str) -> object:
+        color = DELTA_COLORS[change_type]
+        if name in node_of:
+            key = collector.instances[node_of[name]]
+            label = nodes[name][0]
+        else:
+            key = ("removed", name)
+            label = old_nodes[name][0]
+        if key not in delta.ids:
+            delta.add_node(key, style="filled", fillcolor=color, label=label)
+        return key
+
+    for name in sorted(change):
+        add(name, change[name])
+
+    for from_name, to_name, label in sorted(edges - old_edges):
+        delta.add_relation(
+            add(from_name, change.get(from_name, "context")),
+            add(to_name, change.get(to_name, "context")),
+            label=label or None,
+            color="green",
+        )
+    for from_name, to_name, label in sorted(old_edges - edges):
+        delta.add_relation(
+            add(from_name, change.get(from_name, "context")),
+            add(to_name, change.get(to_name, "context")),
+            label=label or None,
+            color="red",
+            style="dashed",
+        )
+    # the unchanged edges of the changed nodes form the context ring
+    for from_name, to_name, label in sorted(edges & old_edges):
+        if from_name in change or to_name in change:
+            delta.add_relation(
+                add(from_name, change.get(from_name, "context")),
+                add(to_name, change.get(to_name, "context")),
+                label=label or None,
+                color="gray",
+            )
+
+    return delta
+
+
 def parse_cfg(cfg):
     entries = cfg.replace("]", "").split(",")
     result = {}
@@ -424,7 +1625,7 @@ def parse_entity(line, scope, relcollector):
 
     dot = ""
     for type_def in types:
-        relcollector.add_node(Node(id(type_def), label=type_def.get_full_name()))
+        relcollector.add_node(id(type_def), label=type_def.get_full_name())
         if rel:
             add_relations(type_def, relcollector)
         if parents:
@@ -523,15 +1724,31 @@ def parse_class_relation(link, scope, relcollector):
         relcollector.add(type_def, rel.type)
 
 
-def generate_dot(name, diagram_config, types):
-    dot = "graph {\n"
-    dot += "  // name: {0}\n".format(name)
+def write_graph(name: str, collector: "GraphCollector", fd: "TextIO") -> None:
+    """
+    Write a collected graph as dot to fd
+    """
+    fd.write("graph {\n")
+    fd.write("  // name: {0}\n".format(name))
+    collector.write_dot(fd)
+    fd.write("}\n")
 
+
+def write_dot(name, diagram_config, types, fd: "TextIO") -> None:
+    """
+    Collect the graph and write it as dot to fd
+    """
     relations = GraphCollector()
     collect_graph(diagram_config, types, relations)
-    dot += relations.dump_dot()
+    if relations.groups:
+        relations = aggregate(relations)
+    write_graph(name, relations, fd)
 
-    return dot + "}\n"
+
+def generate_dot(name, diagram_config, types):
+    dot = io.StringIO()
+    write_dot(name, diagram_config, types, dot)
+    return dot.getvalue()
 
 
 def generate_plant_uml(config, scope):
@@ -545,11 +1762,99 @@ def generate_plant_uml(config, scope):
     return dot + "@enduml\n"
 
 
+class CollectionPlan(object):
+    """
+    Collect the graphs of many diagrams at once. The lines of all diagrams are grouped by entity type, so the instances
+    of every type are scanned only once and the attributes of every instance are read only once. Diagrams with the same
+    filter share the compiled filter, so its lines are only evaluated once.
+    """
+
+    def __init__(self, names: "Optional[NodeNames]" = None, report: "Optional[Report]" = None) -> None:
+        """
+        :param report: Count the instances scanned and the nodes, edges and clusters added by every line in this report
+        """
+        self.names = names if names is not None else NodeNames()
+        self.report = report if report is not None else Report("graph", enabled=False)
+        # the compiled filter, the collector and the name of each diagram
+        self.diagrams: "List[Tuple[GraphFilter, GraphCollector, str]]" = []
+        # the lines of all distinct filters, grouped by their entity type selector
+        self.lines: "Dict[str, List[Config]]" = {}
+        self._filters: "Set[int]" = set()
+
+    def add_diagram(self, diagram_config: str, collector: "GraphCollector", name: str = "") -> None:
+        """
+        :raises FilterSyntaxException: The filter of the diagram contains lines that can not be parsed
+        """
+        graph_filter = compile_filter(diagram_config)
+        self.diagrams.append((graph_filter, collector, name))
+
+        if id(graph_filter) in self._filters:
+            return
+        self._filters.add(id(graph_filter))
+        for entity, lines in graph_filter.entities.items():
+            self.lines.setdefault(entity, []).extend(lines)
+
+    def execute(self, scope) -> None:
+        attributes = AttributeCache()
+        results = {}
+
+        # resolve the selectors of all lines to the entity types to scan
+        index = TypeIndex(scope)
+        entities: "Dict[str, List[Config]]" = {}
+        for selector, lines in self.lines.items():
+            for line in lines:
+                results[id(line)] = []
+
+            resolved = index.resolve(selector)
+            if not resolved:
+                for line in lines:
+                    LOGGER.warning("line %d: %s does not select any entity type", line.lineno, selector)
+            for entity in resolved:
+                entities.setdefault(entity, []).extend(lines)
+
+        scanned = Counter()
+        for entity, lines in entities.items():
+            instances = scope[entity].get_all_instances()
+            for line in lines:
+                scanned[id(line)] += len(instances)
+            for instance in instances:
+                for line in lines:
+                    result = line.match(instance, attributes)
+                    if result is not None:
+                        results[id(line)].append((instance, result))
+
+        # apply the matches of a line in a deterministic order, so overwritten settings do not depend on the order of the
+        # instances. Only the matched instances are named, the instances that are filtered out are not read any further.
+        for matches in results.values():
+            matches.sort(key=lambda match: self.names.get(match[0]))
+
+        # apply the results in the order of the lines of each diagram
+        for graph_filter, collector, name in self.diagrams:
+            for line in graph_filter.lines:
+                if not self.report.enabled:
+                    for instance, result in results[id(line)]:
+                        line.apply(collector, instance, result)
+                    continue
+
+                nodes, edges, clusters = len(collector), collector.edge_count(), len(collector.children)
+                for instance, result in results[id(line)]:
+                    line.apply(collector, instance, result)
+                self.report.add_line(
+                    name,
+                    line.lineno,
+                    line.line,
+                    scanned=scanned[id(line)],
+                    matched=len(results[id(line)]),
+                    nodes=len(collector) - nodes,
+                    edges=collector.edge_count() - edges,
+                    clusters=len(collector.children) - clusters,
+                )
+
+
 def collect_graph(diagram_config, scope, collector):
-    for line in diagram_config.split("\n"):
-        config_line = parse_config_line(collector, line)
-        if config_line is not None:
-            config_line.collect(scope)
+    plan = CollectionPlan(collector.names)
+    plan.add_diagram(diagram_config, collector)
+    plan.execute(scope)
 
     # for t in types:
     #     if t[0] == "@":
@@ -564,23 +1869,255 @@ def collect_graph(diagram_config, scope, collector):
     #         parse_instance_relation(link, scope, relations)
 
 
-def generate_plantuml(
+def collect_focus(diagram_config: str, scope, collector: "GraphCollector", focus: str, hops: int) -> None:
+    """
+    Collect the part of a diagram that is reachable from the root instances within the given number of hops. Only the
+    relation lines of the filter are followed, and only the instances that are reached are evaluated, so the work is
+    proportional to the size of the neighbourhood instead of the size of the model.
+
+    Relation lines are followed in both directions. A line is walked backwards from its target through the other end of
+    each relation in its path, a line with a relation without another end is only followed from its source.
+
+    :param focus: The selector of the root instances, see FocusConfig
+    :param hops: The number of relation lines to follow from the roots
+    :raises ParseException: The filter or the focus can not be parsed
+    """
+    graph_filter = compile_filter(diagram_config)
+    root = FocusConfig(focus)
+    index = TypeIndex(scope)
+    check_predicates(graph_filter, index)
+    attributes = AttributeCache()
+
+    # the lines of the filter that apply to each entity type
+    lines_of: "Dict[Entity, List[Config]]" = {}
+
+    def lines(instance) -> "List[Config]":
+        entity_lines = lines_of.get(instance.type)
+        if entity_lines is None:
+            entity_lines = [line for line in graph_filter.lines if index.selects(line.entity, instance.type)]
+            lines_of[instance.type] = entity_lines
+        return entity_lines
+
+    # the relation lines that end in each entity type, with the other ends of their relation path in reverse order
+    inverse_of: "Dict[Entity, List[Tuple[RelationConfig, List[str]]]]" = {}
+
+    def inverse_path(entity: "Entity", relation: "List[str]") -> "Optional[Tuple[Entity, List[str]]]":
+        ends = []
+        for hop in relation:
+            attribute = entity.get_attribute(parse_hop(hop).name)
+            if not isinstance(attribute, RelationAttribute) or attribute.end is None:
+                return None
+            ends.append(attribute.end.get_name())
+            entity = attribute.get_type()
+        return entity, ends[::-1]
+
+    def inverse_lines(instance) -> "List[Tuple[RelationConfig, List[str]]]":
+        entity_lines = inverse_of.get(instance.type)
+        if entity_lines is None:
+            entity_lines = []
+            for line in graph_filter.lines:
+                if not isinstance(line, RelationConfig):
+                    continue
+                for name in index.resolve(line.entity):
+                    inverse = inverse_path(index.entities[name], line.relation)
+                    if inverse is not None and index.selects(inverse[0].get_full_name(), instance.type):
+                        entity_lines.append((line, inverse[1]))
+            inverse_of[instance.type] = entity_lines
+        return entity_lines
+
+    def sources(instance, ends: "List[str]") -> "List[object]":
+        current = [instance]
+        for end in ends:
+            reached = {}
+            for value in current:
+                value_attributes = attributes.get(value)
+                if end not in value_attributes:
+                    continue
+                values = value_attributes[end]
+                for source in values if isinstance(values, list) else [values]:
+                    reached[source] = None
+            current = list(reached)
+        return current
+
+    frontier = sorted(
+        (
+            instance
+            for entity in index.resolve(root.entity)
+            for instance in scope[entity].get_all_instances()
+            if root.match(instance, attributes) is not None
+        ),
+        key=collector.names.get,
+    )
+    if not frontier:
+        LOGGER.warning("focus %s does not select any instance", focus)
+
+    visited = set(frontier)
+    # the result of every line for every instance, the targets of a relation line are merged when it is walked in both
+    # directions
+    results: "Dict[Tuple[int, object], Tuple[Config, object, object]]" = {}
+
+    def add_result(line: "Config", instance, result, reached: "List[object]") -> None:
+        key = (id(line), instance)
+        if isinstance(line, RelationConfig):
+            if key in results:
+                result = tuple(dict.fromkeys(results[key][2] + result))
+            for target in result:
+                if target not in visited and NodeNames._is_instance(target):
+                    visited.add(target)
+                    reached.append(target)
+        results[key] = (line, instance, result)
+
+    for hop in range(hops + 1):
+        reached = []
+        for instance in frontier:
+            for line in lines(instance):
+                if isinstance(line, RelationConfig) and hop == hops:
+                    continue
+                result = line.match(instance, attributes)
+                if result is not None:
+                    add_result(line, instance, result, reached)
+            if hop == hops:
+                continue
+            for line, ends in inverse_lines(instance):
+                for source in sources(instance, ends):
+                    if not NodeNames._is_instance(source) or not index.selects(line.entity, source.type):
+                        continue
+                    # only the edge to this instance, the other targets of the source are not in reach
+                    result = line.match(source, attributes)
+                    if result is not None and instance in result:
+                        add_result(line, source, (instance,), reached)
+                        if source not in visited:
+                            visited.add(source)
+                            reached.append(source)
+        frontier = reached
+
+    # apply the results in the order of the lines of the filter, like CollectionPlan
+    order = {id(line): position for position, line in enumerate(graph_filter.lines)}
+    for line, instance, result in sorted(results.values(), key=lambda result: order[id(result[0])]):
+        line.apply(collector, instance, result)
+
+
+class ClassIndex(object):
+    """
+    The entity types of the model with their attributes, relations and parents, built once per export and shared by all
+    class diagrams. The PlantUML fragment of every class and relation is generated once and reused by every diagram
+    that contains it.
+    """
+
+    def __init__(self, types: "Dict[str, object]") -> None:
+        self.entities: "Dict[str, Entity]" = {name: t for name, t in types.items() if isinstance(t, Entity)}
+        self._attributes: "Dict[Entity, Tuple[List[object], List[RelationAttribute]]]" = {}
+        self._selected: "Dict[Tuple[str, ...], Dict[str, Entity]]" = {}
+        self._classes: "Dict[Tuple[Entity, bool], str]" = {}
+        self._relations: "Dict[RelationAttribute, str]" = {}
+
+    @staticmethod
+    def module(entity: "Entity") -> str:
+        return entity.get_full_name().rsplit("::", 1)[0]
+
+    def select(self, moduleexpression: "List[str]") -> "Dict[str, Entity]":
+        """
+        The entity types with a name that matches one of the regular expressions, in the order of the model
+        """
+        key = tuple(moduleexpression)
+        selected = self._selected.get(key)
+        if selected is None:
+            expressions = [re.compile(r) for r in moduleexpression]
+            selected = {k: v for k, v in self.entities.items() if any(r.match(k) for r in expressions)}
+            self._selected[key] = selected
+        return selected
+
+    def _split(self, entity: "Entity") -> "Tuple[List[object], List[RelationAttribute]]":
+        split = self._attributes.get(entity)
+        if split is None:
+            all_attributes = entity.get_attributes().values()
+            split = (
+                [a for a in all_attributes if not isinstance(a, RelationAttribute)],
+                [r for r in all_attributes if isinstance(r, RelationAttribute)],
+            )
+            self._attributes[entity] = split
+        return split
+
+    def attributes(self, entity: "Entity") -> "List[object]":
+        return self._split(entity)[0]
+
+    def relations(self, entity: "Entity") -> "List[RelationAttribute]":
+        return self._split(entity)[1]
+
+    def emit_class(self, entity: "Entity", attributes: bool = True) -> str:
+        key = (entity, attributes)
+        fragment = self._classes.get(key)
+        if fragment is None:
+            if not attributes:
+                fragment = "class %s" % entity.get_full_name()
+            else:
+                atts = ["%s %s" % (a.get_type().type_string(), a.get_name()) for a in self.attributes(entity)]
+                fragment = """class %s {
+    %s
+}""" % (
+                    entity.get_full_name(),
+                    "\n".join(atts),
+                )
+            self._classes[key] = fragment
+        return fragment
+
+    @staticmethod
+    def arity(r: "RelationAttribute") -> str:
+        if r.low == 1:
+            if r.high == 1:
+                return "1"
+            if r.high is None:
+                return "+"
+        if r.low == 0:
+            if r.high == 1:
+                return "?"
+            if r.high is None:
+                return "*"
+        return "[%d:%s]" % (r.low, r.high if r.high is not None else "")
+
+    def emit_relation(self, r: "RelationAttribute") -> str:
+        fragment = self._relations.get(r)
+        if fragment is None:
+            if r.end is None:
+                fragment = '%s "%s" -->  %s: %s' % (
+                    r.get_entity().get_full_name(),
+                    self.arity(r),
+                    r.get_type().get_full_name(),
+                    r.get_name(),
+                )
+            else:
+                fragment = """%s "%s" -- "%s" %s : %s >""" % (
+                    r.get_entity().get_full_name(),
+                    self.arity(r),
+                    self.arity(r.end),
+                    r.get_type().get_full_name(),
+                    r.get_name(),
+                )
+            self._relations[r] = fragment
+        return fragment
+
+
+def plantuml_lines(
     moduleexpression,
     types,
     parents_to_root=True,
     relations_escape=True,
     attributes=True,
-):
-    moduleexpression = [re.compile(r) for r in moduleexpression]
+    index: "Optional[ClassIndex]" = None,
+) -> "List[Tuple[str, str]]":
+    """
+    The lines of a class diagram: the classes, the inheritance and the relations, each with the module it belongs to
 
-    def name_matches(name):
-        return any((r.match(name) for r in moduleexpression))
+    :param index: The index of the entity types to share between diagrams, it is built from types when not provided
+    """
+    if index is None:
+        index = ClassIndex(types)
 
     # collect types
-    mytypes = {k: v for k, v in types.items() if name_matches(k) and isinstance(v, Entity)}
+    mytypes = index.select(moduleexpression)
 
     # collect relations
-    allrelations = [r for e in mytypes.values() for r in e.get_attributes().values() if isinstance(r, RelationAttribute)]
+    allrelations = [r for e in mytypes.values() for r in index.relations(e)]
     if not relations_escape:
         allrelations = [r for r in allrelations if r.get_type().get_full_name() in mytypes]
 
@@ -591,63 +2128,55 @@ def generate_plantuml(
         if r.end not in paired:
             paired[r] = None
 
-    def emit_class(entity):
-        if not attributes:
-            return "class %s" % entity.get_full_name()
-        else:
-            myattributes = [r for r in entity.get_attributes().values() if not isinstance(r, RelationAttribute)]
-            atts = ["%s %s" % (a.get_type().type_string(), a.get_name()) for a in myattributes]
-            return """class %s {
-    %s
-}""" % (
-                entity.get_full_name(),
-                "\n".join(atts),
-            )
-
     # emit classes
-    classes = [emit_class(cl) for cl in mytypes.values()]
+    classes = [(index.module(cl), index.emit_class(cl, attributes)) for cl in mytypes.values()]
     # emit inheritance
     inh = [
-        "%(parent)s <|-- %(child)s" % {"parent": parent, "child": child}
+        (index.module(child), "%(parent)s <|-- %(child)s" % {"parent": parent, "child": child})
         for child in mytypes.values()
         for parent in child.parent_entities
         if parent.get_full_name() != "std::Entity" and (parents_to_root or parent.get_full_name() in mytypes)
     ]
 
     # emit relations
-    def arity(r):
-        if r.low == 1:
-            if r.high == 1:
-                return "1"
-            if r.high is None:
-                return "+"
-        if r.low == 0:
-            if r.high == 1:
-                return "?"
-            if r.high is None:
-                return "*"
-        return "[%d:%s]" % (r.low, r.high if r.high is not None else "")
+    rel = [(index.module(r.get_entity()), index.emit_relation(r)) for r in paired.keys()]
 
-    def emit_relation(r):
-        if r.end is None:
-            return '%s "%s" -->  %s: %s' % (
-                r.get_entity().get_full_name(),
-                arity(r),
-                r.get_type().get_full_name(),
-                r.get_name(),
-            )
-        else:
-            return """%s "%s" -- "%s" %s : %s >""" % (
-                r.get_entity().get_full_name(),
-                arity(r),
-                arity(r.end),
-                r.get_type().get_full_name(),
-                r.get_name(),
-            )
+    return classes + inh + rel
+
+
+def generate_plantuml(
+    moduleexpression,
+    types,
+    parents_to_root=True,
+    relations_escape=True,
+    attributes=True,
+    index: "Optional[ClassIndex]" = None,
+):
+    """
+    :param index: The index of the entity types to share between diagrams, it is built from types when not provided
+    """
+    lines = plantuml_lines(moduleexpression, types, parents_to_root, relations_escape, attributes, index)
+    return "\n".join(line for _, line in lines)
 
-    rel = [emit_relation(r) for r in paired.keys()]
 
-    return "\n".join(classes + inh + rel)
+def generate_plantuml_fragments(
+    moduleexpression,
+    types,
+    parents_to_root=True,
+    relations_escape=True,
+    attributes=True,
+    index: "Optional[ClassIndex]" = None,
+) -> "Dict[str, str]":
+    """
+    Generate a class diagram as one fragment per module, with the classes of the module, their inheritance and their
+    relations. Together the fragments contain the same lines as generate_plantuml.
+
+    :return: The fragment of every module, by module name
+    """
+    fragments: "Dict[str, List[str]]" = {}
+    for module, line in plantuml_lines(moduleexpression, types, parents_to_root, relations_escape, attributes, index):
+        fragments.setdefault(module, []).append(line)
+    return {module: "\n".join(lines) for module, lines in fragments.items()}
 
 
 @export("graph", "graph::Graph")
@@ -659,52 +2188,174 @@ def export_graph(exporter, types):
     if not os.path.exists(outdir):
         os.mkdir(outdir)
 
-    file_types = [x.strip() for x in config.Config.get("graph", "types", "png").split(",")]
+    types_setting = [x.strip() for x in config.Config.get("graph", "types", "png").split(",") if x.strip()]
+    # the data formats and the viewer are written from the collected graph, all other types are rendered by graphviz
+    data_types = [x for x in types_setting if x in FORMATS]
+    viewer = VIEWER_TYPE in types_setting
+    file_types = [x for x in types_setting if x not in FORMATS and x != VIEWER_TYPE]
+
+    workers = int(config.Config.get("graph", "workers", 0)) or None
+    timeout = float(config.Config.get("graph", "render-timeout", 600)) or None
+    max_nodes = int(config.Config.get("graph", "max-nodes", 10000))
+    max_edges = int(config.Config.get("graph", "max-edges", 50000))
+    fold_degree = int(config.Config.get("graph", "fold-degree", 1000))
+    fold_keep = int(config.Config.get("graph", "fold-keep", 0))
+    fold_pattern = config.Config.get("graph", "fold-keep-pattern", "")
+    dot_max_nodes = int(config.Config.get("graph", "dot-max-nodes", 2000))
+    dot_max_edges = int(config.Config.get("graph", "dot-max-edges", 5000))
+    delta = convert_boolean(config.Config.get("graph", "delta", False))
+    report = Report("graph", convert_boolean(config.Config.get("graph", "report", False)))
+    in_process = config.Config.get("graph", "renderer", "subprocess") == "bindings"
+    if in_process and not bindings_available():
+        LOGGER.info("The graphviz bindings (pygraphviz) are not installed, graphs are rendered with a graphviz subprocess")
+        in_process = False
+    cache = RenderCache(os.path.join(outdir, ".cache"), int(float(config.Config.get("graph", "cache-size", 256)) * 2**20))
 
     # Get all diagrams
     diagram_type = types["graph::Graph"]
 
+    # collect all diagrams in a single scan of the model
+    names = NodeNames()
+    plan = CollectionPlan(names, report)
+    index = TypeIndex(exporter.types)
+    collectors = []
     for graph in diagram_type:
-        dot = generate_dot(graph.name, graph.config, exporter.types)
-        filename = os.path.join(outdir, "%s.dot" % graph.name)
+        collector = GraphCollector(names)
+        try:
+            if graph.focus:
+                # a focused graph only walks the neighbourhood of its roots instead of joining the scan
+                with report.phase(graph.name, "collect"):
+                    collect_focus(graph.config, exporter.types, collector, graph.focus, graph.focus_hops)
+            else:
+                with report.phase(graph.name, "compile filter"):
+                    check_predicates(compile_filter(graph.config), index)
+                    plan.add_diagram(graph.config, collector, graph.name)
+        except FilterSyntaxException as e:
+            LOGGER.error("Skipping graph %s, its filter is invalid:\n%s", graph.name, e)
+            continue
+        except ParseException:
+            LOGGER.error("Skipping graph %s, its focus %s is invalid", graph.name, graph.focus)
+            continue
+        collectors.append((graph, collector))
+    # the scan is shared by all diagrams
+    with report.phase("*", "collect"):
+        plan.execute(exporter.types)
 
-        with open(filename, "w+") as fd:
-            fd.write(dot)
+    jobs = []
+    digests = {}
 
-        for file_type in file_types:
-            try:
-                subprocess.check_call(
-                    [
-                        "dot",
-                        "-T%s" % file_type,
-                        "-Goverlap=scale",
-                        "-Gdefaultdist=0.1",
-                        "-Gsplines=true",
-                        "-Gsep=.1",
-                        "-Gepsilon=.0000001",
-                        "-o",
-                        os.path.join(outdir, "%s.%s" % (graph.name, file_type)),
-                        filename,
-                    ]
-                )
-            except Exception:
-                print(
-                    "Could not render graph, please execute "
-                    + " ".join(
-                        [
-                            "dot",
-                            "-T%s" % file_type,
-                            "-Goverlap=scale",
-                            "-Gdefaultdist=0.1",
-                            "-Gsplines=true",
-                            "-Gsep=.1",
-                            "-Gepsilon=.0000001",
-                            "-o",
-                            os.path.join(outdir, "%s.%s" % (graph.name, file_type)),
-                            filename,
-                        ]
-                    )
-                )
+    def reduce(name: str, collector: GraphCollector, graph) -> GraphCollector:
+        with report.phase(name, "reduce"):
+            return reduce_graph(name, collector, graph.aggregate, max_nodes, max_edges, fold_degree, fold_keep, fold_pattern)
+
+    def add_job(name: str, collected: GraphCollector, graph, layout: "Optional[GraphCollector]" = None) -> None:
+        """
+        Write the data formats and the viewer of the collected graph and lay out the graph after applying the budget to it.
+        The data formats and the viewer do not need a layout, so they contain every collected instance.
+
+        :param layout: The graph to lay out instead of the collected graph
+        """
+        for data_type in data_types:
+            extension, writer = FORMATS[data_type]
+            with report.phase(name, "write %s" % data_type):
+                with open(os.path.join(outdir, "%s.%s" % (name, extension)), "w", buffering=WRITE_BUFFER_SIZE) as fd:
+                    writer(collected, fd)
+
+        if viewer:
+            with report.phase(name, "write viewer"):
+                write_viewer(name, collected, outdir)
+
+        collector = reduce(name, layout if layout is not None else collected, graph)
+        filename = os.path.join(outdir, "%s.dot" % name)
+
+        with report.phase(name, "write dot"):
+            with open(filename, "w+", buffering=WRITE_BUFFER_SIZE) as fd:
+                write_graph(name, collector, fd)
+                dot_bytes = fd.tell()
+        report.count(
+            name, nodes=len(collector), edges=collector.edge_count(), clusters=len(collector.children), dot_bytes=dot_bytes
+        )
+
+        if not file_types:
+            # nothing to lay out
+            return
+
+        engine = graph.engine
+        if not engine:
+            engine = select_engine(len(collector), collector.edge_count(), dot_max_nodes, dot_max_edges)
+            LOGGER.info(
+                "Graph %s has %d nodes and %d edges, laying it out with %s",
+                name,
+                len(collector),
+                collector.edge_count(),
+                engine,
+            )
+        job = make_job(
+            name, filename, outdir, file_types, engine, graph.engine_options.split(), collector if in_process else None
+        )
+        with report.phase(name, "render cache"):
+            digests[name] = cache.digest_file(filename, job.options())
+            # only render the file types that are not in the cache
+            job.outputs = {
+                file_type: output
+                for file_type, output in job.outputs.items()
+                if not cache.fetch(digests[name], file_type, output)
+            }
+        jobs.append(job)
+
+    for graph, collected in collectors:
+        name = graph.name
+        if delta:
+            # compare the collected graph with the snapshot of the previous export, before the budget aggregates it
+            with report.phase(name, "delta"):
+                current = snapshot(collected)
+                snapshot_file = os.path.join(outdir, "%s.snapshot.json" % name)
+                changes = None
+                try:
+                    with open(snapshot_file, "r") as fd:
+                        previous = json.load(fd)
+                except (OSError, ValueError):
+                    # no previous export, or its snapshot can not be read
+                    previous = None
+                if previous is not None:
+                    changes = delta_graph(collected, current, previous)
+                with open(snapshot_file, "w") as fd:
+                    json.dump(current, fd)
+            if changes is not None and (len(changes) or changes.edge_count()):
+                LOGGER.info("Graph %s: the changes since the previous export have %d nodes", name, len(changes))
+                add_job("%s.delta" % name, changes, graph)
+            elif changes is not None:
+                LOGGER.info("Graph %s has not changed since the previous export", name)
+        layout = None
+        if graph.paged:
+            # every page is laid out on its own, the graph itself becomes the overview of the pages. The collected graph is
+            # split, the budget applies to every page on its own.
+            link_type = file_types[0] if file_types else "dot"
+            with report.phase(name, "partition"):
+                pages, overview = partition(name, collected, link_type)
+            if len(pages) > 1:
+                for page in pages:
+                    add_job(page.name, page.collector, graph)
+                with open(os.path.join(outdir, "%s.html" % name), "w") as fd:
+                    write_index(name, pages, link_type, fd)
+                layout = overview
+        add_job(name, collected, graph, layout)
+
+    with report.phase("*", "render"):
+        durations = render_all(jobs, workers, timeout)
+
+    for job in jobs:
+        if job.name in durations:
+            report.count(job.name, engine=job.engine, render_seconds=durations[job.name])
+            for file_type, output in job.outputs.items():
+                cache.store(digests[job.name], file_type, output)
+
+    if cache.enabled:
+        cache.evict()
+    if cache.consulted:
+        LOGGER.info(cache.summary())
+
+    report.write(os.path.join(outdir, "graph-report.json"))
 
 
 @export("classdiagram", "graph::ClassDiagram")
@@ -716,18 +2367,108 @@ def export_classdiagram(exporter, types):
     if not os.path.exists(outdir):
         os.mkdir(outdir)
 
+    # render with plantuml when a command is configured, for example "plantuml" or "java -jar plantuml.jar"
+    plantuml = shlex.split(config.Config.get("graph", "plantuml", ""))
+    puml_files = []
+    report = Report("classdiagram", convert_boolean(config.Config.get("graph", "report", False)))
+
     # Get all diagrams
     diagram_type = types["graph::ClassDiagram"]
+    with report.phase("*", "index"):
+        index = ClassIndex(exporter.types)
+    includes = {}
     for graph in diagram_type:
-        cdiag = generate_plantuml(graph.moduleexpression, exporter.types)
         filename = os.path.join(outdir, "%s.puml" % graph.name)
+        with report.phase(graph.name, "generate"):
+            if graph.fragmented:
+                includes[filename] = write_fragments(outdir, graph.name, graph.moduleexpression, exporter.types, index)
+                puml_files.extend(includes[filename])
+                cdiag = "\n".join("!include %s/%s" % (graph.name, os.path.basename(f)) for f in includes[filename])
+            else:
+                cdiag = generate_plantuml(graph.moduleexpression, exporter.types, index=index)
+
+        with report.phase(graph.name, "write puml"):
+            with open(filename, "w+") as fd:
+                fd.write("@startuml\n")
+                if graph.header != "":
+                    fd.write(graph.header + "\n")
+                fd.write(cdiag)
+                fd.write("\n@enduml\n")
+                report.count(graph.name, classes=len(index.select(graph.moduleexpression)), puml_bytes=fd.tell())
+
+        puml_files.append(filename)
+
+    if plantuml:
+        with report.phase("*", "render"):
+            render_plantuml(outdir, plantuml, puml_files, includes)
+
+    report.write(os.path.join(outdir, "classdiagram-report.json"))
+
 
-        with open(filename, "w+") as fd:
-            fd.write("@startuml\n")
-            if graph.header != "":
-                fd.write(graph.header + "\n")
-            fd.write(cdiag)
-            fd.write("\n@enduml\n")
+def write_fragments(outdir: str, name: str, moduleexpression, types, index: ClassIndex) -> "List[str]":
+    """
+    Write the fragment of every module of a class diagram to <outdir>/<name>/<module>.puml. A fragment is only written
+    when its content changed, so unchanged modules keep their file and their cached render.
+
+    :return: The fragment files, in the order of the modules in the diagram
+    """
+    directory = os.path.join(outdir, name)
+    if not os.path.exists(directory):
+        os.mkdir(directory)
+
+    files = []
+    for module, fragment in generate_plantuml_fragments(moduleexpression, types, index=index).items():
+        filename = os.path.join(directory, "%s.puml" % module.replace("::", "."))
+        content = "@startuml\n%s\n@enduml\n" % fragment
+        if os.path.exists(filename):
+            with open(filename, "r") as fd:
+                if fd.read() == content:
+                    files.append(filename)
+                    continue
+        with open(filename, "w") as fd:
+            fd.write(content)
+        files.append(filename)
+    return files
+
+
+def render_plantuml(
+    outdir: str, plantuml: "List[str]", puml_files: "List[str]", includes: "Optional[Dict[str, List[str]]]" = None
+) -> None:
+    """
+    Render the class diagrams with PlantUML. All diagrams that are not in the render cache are rendered in a few
+    batches, so the JVM is started once per batch instead of once per diagram.
+
+    :param includes: The files included by each diagram, they are part of the cache key of the diagram
+    """
+    includes = includes or {}
+    file_types = [x.strip() for x in config.Config.get("graph", "plantuml-types", "svg").split(",") if x.strip()]
+    batches = int(config.Config.get("graph", "plantuml-workers", 1))
+    timeout = float(config.Config.get("graph", "render-timeout", 600)) or None
+    cache = RenderCache(os.path.join(outdir, ".cache"), int(float(config.Config.get("graph", "cache-size", 256)) * 2**20))
+
+    jobs = []
+    digests = {}
+    for file_type in file_types:
+        changed = []
+        for filename in puml_files:
+            included = [cache.digest_file(f, []) for f in includes.get(filename, [])]
+            digest = cache.digest_file(filename, plantuml + ["-t%s" % file_type] + included)
+            digests[(filename, file_type)] = digest
+            if not cache.fetch(digest, file_type, "%s.%s" % (os.path.splitext(filename)[0], file_type)):
+                changed.append(filename)
+        jobs += make_plantuml_jobs(plantuml, changed, [file_type], batches)
+
+    durations = render_all(jobs, batches, timeout)
+
+    for job in jobs:
+        if job.name in durations:
+            for filename in job.puml_files:
+                cache.store(digests[(filename, job.file_type)], job.file_type, job.output(filename))
+
+    if cache.enabled:
+        cache.evict()
+    if cache.consulted:
+        LOGGER.info(cache.summary())
 
 
 # @export("classdiagram", "graph::Graph")
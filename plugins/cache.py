@@ -0,0 +1,135 @@
+"""
+    Copyright 2021 Inmanta
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Contact: code@inmanta.com
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+from typing import List
+
+LOGGER = logging.getLogger(__name__)
+
+
+class RenderCache(object):
+    """
+    A size bounded cache of rendered graphs, keyed on the dot text, the render options and the file type.
+
+    The dot text of a graph only changes when the model changes, because node names are derived from the model.
+    """
+
+    def __init__(self, directory: str, max_size: int) -> None:
+        """
+        :param directory: The directory to store the rendered graphs in
+        :param max_size: The maximal size of the cache in bytes, 0 to disable the cache
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+        if self.enabled and not os.path.exists(directory):
+            os.mkdir(directory)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def digest(self, dot: str, options: List[str]) -> str:
+        """
+        Hash the dot text and the options used to render it
+        """
+        content = hashlib.sha256(dot.encode())
+        return self._digest(content, options)
+
+    def digest_file(self, path: str, options: List[str]) -> str:
+        """
+        Hash the dot file and the options used to render it
+        """
+        content = hashlib.sha256()
+        with open(path, "rb") as fd:
+            for chunk in iter(lambda: fd.read(2**20), b""):
+                content.update(chunk)
+        return self._digest(content, options)
+
+    def _digest(self, content: "hashlib._Hash", options: List[str]) -> str:
+        for option in options:
+            content.update(b"\0")
+            content.update(option.encode())
+        return content.hexdigest()
+
+    def _path(self, digest: str, file_type: str) -> str:
+        return os.path.join(self.directory, "%s.%s" % (digest, file_type))
+
+    def fetch(self, digest: str, file_type: str, output: str) -> bool:
+        """
+        Copy the cached render to output
+
+        :return: True when the render was in the cache
+        """
+        if not self.enabled:
+            return False
+
+        path = self._path(digest, file_type)
+        if not os.path.exists(path):
+            self.misses += 1
+            return False
+
+        shutil.copyfile(path, output)
+        # mark as recently used
+        os.utime(path)
+        self.hits += 1
+        return True
+
+    def store(self, digest: str, file_type: str, output: str) -> None:
+        """
+        Add a rendered graph to the cache
+        """
+        if not self.enabled or not os.path.exists(output):
+            return
+
+        shutil.copyfile(output, self._path(digest, file_type))
+
+    def evict(self) -> None:
+        """
+        Remove the least recently used entries until the cache fits in its maximal size
+        """
+        if not self.enabled:
+            return
+
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            os.remove(path)
+            total -= size
+
+    @property
+    def consulted(self) -> bool:
+        """
+        Was the cache asked for a render
+        """
+        return self.hits + self.misses > 0
+
+    def summary(self) -> str:
+        return "Render cache: %d hits, %d misses" % (self.hits, self.misses)
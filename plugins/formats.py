@@ -0,0 +1,133 @@
+"""
+    Copyright 2021 Inmanta
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Contact: code@inmanta.com
+"""
+
+import json
+from typing import Callable, Dict, Iterator, List, TextIO, Tuple
+from xml.sax.saxutils import escape, quoteattr
+
+# the number of elements that are written to the file at once
+CHUNK_SIZE = 1000
+
+
+def _write_chunked(fd: "TextIO", lines: "Iterator[str]") -> None:
+    chunk: "List[str]" = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= CHUNK_SIZE:
+            fd.writelines(chunk)
+            chunk.clear()
+    fd.writelines(chunk)
+
+
+def _node_data(collector, node: int, containers: "Dict[int, int]") -> "Dict[str, object]":
+    props = collector.node_props(node)
+    data = {"id": collector.node_name(node), "label": str(props.get("label", collector.node_name(node)))}
+    entity = collector.entity_name(node)
+    if entity is not None:
+        data["entity"] = entity
+    if node in containers:
+        data["parent"] = collector.node_name(containers[node])
+    if collector.subgraph[node]:
+        data["container"] = True
+    return data
+
+
+def _edge_data(collector, edge: int) -> "Dict[str, object]":
+    data = {"source": collector.node_name(collector.edge_from[edge]), "target": collector.node_name(collector.edge_to[edge])}
+    label = collector.edge_options[edge].get("label")
+    if label is not None:
+        data["label"] = str(label)
+    return data
+
+
+def write_jsonl(collector, fd: "TextIO") -> None:
+    """
+    Write the graph as newline delimited json, one object per node followed by one object per edge
+    """
+
+    def lines() -> "Iterator[str]":
+        containers = collector.container_of()
+        for node in collector.sorted_nodes():
+            yield json.dumps({"type": "node", **_node_data(collector, node, containers)}) + "\n"
+        for edge in collector.sorted_edges():
+            yield json.dumps({"type": "edge", **_edge_data(collector, edge)}) + "\n"
+
+    _write_chunked(fd, lines())
+
+
+def write_cytoscape(collector, fd: "TextIO") -> None:
+    """
+    Write the graph in the cytoscape.js json format, containers are compound nodes
+    """
+
+    def lines() -> "Iterator[str]":
+        containers = collector.container_of()
+        yield '{"elements": {"nodes": [\n'
+        separator = ""
+        for node in collector.sorted_nodes():
+            yield separator + json.dumps({"data": _node_data(collector, node, containers)})
+            separator = ",\n"
+        yield '\n], "edges": [\n'
+        separator = ""
+        for edge in collector.sorted_edges():
+            data = {"id": "e%d" % edge, **_edge_data(collector, edge)}
+            yield separator + json.dumps({"data": data})
+            separator = ",\n"
+        yield "\n]}}\n"
+
+    _write_chunked(fd, lines())
+
+
+def write_graphml(collector, fd: "TextIO") -> None:
+    """
+    Write the graph as GraphML, the label, entity type and container of the nodes are stored as data keys
+    """
+
+    def data(key: str, value: object) -> str:
+        return '<data key="%s">%s</data>' % (key, escape(str(value)))
+
+    def lines() -> "Iterator[str]":
+        containers = collector.container_of()
+        yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+        yield '<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n'
+        yield '  <key id="label" for="all" attr.name="label" attr.type="string"/>\n'
+        yield '  <key id="entity" for="node" attr.name="entity" attr.type="string"/>\n'
+        yield '  <key id="parent" for="node" attr.name="parent" attr.type="string"/>\n'
+        yield '  <graph edgedefault="undirected">\n'
+        for node in collector.sorted_nodes():
+            node_data = _node_data(collector, node, containers)
+            fields = "".join(data(key, node_data[key]) for key in ("label", "entity", "parent") if key in node_data)
+            yield "    <node id=%s>%s</node>\n" % (quoteattr(node_data["id"]), fields)
+        for edge in collector.sorted_edges():
+            edge_data = _edge_data(collector, edge)
+            yield "    <edge source=%s target=%s>%s</edge>\n" % (
+                quoteattr(edge_data["source"]),
+                quoteattr(edge_data["target"]),
+                data("label", edge_data["label"]) if "label" in edge_data else "",
+            )
+        yield "  </graph>\n</graphml>\n"
+
+    _write_chunked(fd, lines())
+
+
+# the output types that are written directly from the collected graph, without graphviz: type -> (extension, writer)
+FORMATS: "Dict[str, Tuple[str, Callable[[object, TextIO], None]]]" = {
+    "jsonl": ("jsonl", write_jsonl),
+    "graphml": ("graphml", write_graphml),
+    "cytoscape": ("cyjs", write_cytoscape),
+}
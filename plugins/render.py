@@ -0,0 +1,338 @@
+"""
+    Copyright 2021 Inmanta
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Contact: code@inmanta.com
+"""
+
+import logging
+import os
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, List, Optional
+
+try:
+    import pygraphviz
+except ImportError:
+    # the in-process renderer is optional, without it every graph is rendered by a graphviz subprocess
+    pygraphviz = None
+
+LOGGER = logging.getLogger(__name__)
+
+DOT_OPTIONS = [
+    "-Goverlap=scale",
+    "-Gdefaultdist=0.1",
+    "-Gsplines=true",
+    "-Gsep=.1",
+    "-Gepsilon=.0000001",
+]
+
+# the options of each layout engine, engines that are not listed are used without options
+ENGINE_OPTIONS = {
+    "dot": DOT_OPTIONS,
+    # the force directed engines scale to large graphs, straight edges avoid the expensive spline routing
+    "sfdp": ["-Goverlap=prism", "-Gsplines=false", "-Goutputorder=edgesfirst"],
+    "neato": ["-Goverlap=scale", "-Gsplines=true", "-Gsep=.1"],
+    "fdp": ["-Goverlap=scale", "-Gsplines=true", "-Gsep=.1"],
+}
+
+
+def select_engine(nodes: int, edges: int, max_nodes: int = 2000, max_edges: int = 5000) -> str:
+    """
+    Select the layout engine for a graph of the given size. The hierarchical layout of dot gives the best result but slows
+    down badly on large graphs, those are laid out with sfdp.
+
+    :param max_nodes: The maximal number of nodes to lay out with dot
+    :param max_edges: The maximal number of edges to lay out with dot
+    """
+    if nodes > max_nodes or edges > max_edges:
+        return "sfdp"
+    return "dot"
+
+
+class Job(object):
+    """
+    A render for render_all: a command that produces one or more files
+    """
+
+    # jobs that are not thread safe are rendered one after the other, in the thread that calls render_all
+    thread_safe = True
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def pending(self) -> bool:
+        """
+        Is there anything to render
+        """
+        return True
+
+    def describe(self) -> str:
+        """
+        How and to what the job renders, for the log
+        """
+        raise NotImplementedError()
+
+    def command(self) -> List[str]:
+        raise NotImplementedError()
+
+    def size(self) -> int:
+        """
+        An estimate of how long the render will take, the largest jobs are started first
+        """
+        return 0
+
+    def run(self, timeout: Optional[float] = None) -> float:
+        """
+        Render and return the time it took in seconds
+
+        :param timeout: Kill the render and raise :py:class:`subprocess.TimeoutExpired` after this many seconds
+        """
+        start = time.monotonic()
+        subprocess.run(self.command(), check=True, timeout=timeout, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        return time.monotonic() - start
+
+
+class RenderJob(Job):
+    """
+    Render a single dot file to all requested output formats.
+
+    Graphviz accepts multiple -T/-o pairs in one invocation, so the layout is only computed once
+    and every output format is produced from that layout.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        dot_file: str,
+        outputs: Dict[str, str],
+        engine: str = "dot",
+        engine_options: "Optional[List[str]]" = None,
+    ) -> None:
+        """
+        :param name: The name of the graph
+        :param dot_file: The dot file to render
+        :param outputs: A dict with the output file for each file type
+        :param engine: The graphviz layout engine
+        :param engine_options: Additional options for the engine, they are added after the default options of the engine
+        """
+        Job.__init__(self, name)
+        self.dot_file = dot_file
+        self.outputs = outputs
+        self.engine = engine
+        self.engine_options = engine_options or []
+
+    def options(self) -> List[str]:
+        """
+        The layout engine and its options, everything in the command that determines how the graph looks
+        """
+        return [self.engine] + ENGINE_OPTIONS.get(self.engine, []) + self.engine_options
+
+    def pending(self) -> bool:
+        return bool(self.outputs)
+
+    def describe(self) -> str:
+        return "graph %s with %s to %s" % (self.name, self.engine, ", ".join(self.outputs.keys()))
+
+    def command(self) -> List[str]:
+        cmd = self.options()
+        for file_type, output in self.outputs.items():
+            cmd += ["-T%s" % file_type, "-o", output]
+        cmd.append(self.dot_file)
+        return cmd
+
+    def size(self) -> int:
+        """
+        The size of the dot file, used as an estimate of how long the layout will take
+        """
+        try:
+            return os.path.getsize(self.dot_file)
+        except OSError:
+            return 0
+
+
+class PlantUmlJob(Job):
+    """
+    Render a batch of PlantUML files to one file type in a single PlantUML run, so the JVM is only started once for
+    the whole batch. Every file is rendered next to it, with the extension of the file type.
+    """
+
+    def __init__(self, name: str, plantuml: List[str], puml_files: List[str], file_type: str) -> None:
+        """
+        :param plantuml: The command to run PlantUML, for example ["java", "-jar", "plantuml.jar"]
+        :param puml_files: The PlantUML files to render
+        """
+        Job.__init__(self, name)
+        self.plantuml = plantuml
+        self.puml_files = puml_files
+        self.file_type = file_type
+
+    def describe(self) -> str:
+        return "%d class diagrams with PlantUML to %s" % (len(self.puml_files), self.file_type)
+
+    def options(self) -> List[str]:
+        return self.plantuml + ["-t%s" % self.file_type]
+
+    def command(self) -> List[str]:
+        return self.options() + self.puml_files
+
+    def output(self, puml_file: str) -> str:
+        return "%s.%s" % (os.path.splitext(puml_file)[0], self.file_type)
+
+    def size(self) -> int:
+        return sum(os.path.getsize(f) for f in self.puml_files if os.path.exists(f))
+
+
+def make_plantuml_jobs(
+    plantuml: List[str], puml_files: List[str], file_types: List[str], batches: int = 1
+) -> List[PlantUmlJob]:
+    """
+    Split the PlantUML files over the given number of batches for each file type
+    """
+    if not puml_files:
+        return []
+    batches = max(1, min(batches, len(puml_files)))
+    return [
+        PlantUmlJob("plantuml-%s-%d" % (file_type, batch), plantuml, puml_files[batch::batches], file_type)
+        for file_type in file_types
+        for batch in range(batches)
+    ]
+
+
+class BindingsJob(RenderJob):
+    """
+    Render a collected graph in this process with the graphviz library, through pygraphviz. This avoids starting a
+    process and parsing the dot file, which costs more than the layout of a small graph.
+
+    The graphviz library is not thread safe, so these jobs are run one after the other and the timeout does not apply.
+    When the in-process render fails, the graph is rendered with a subprocess.
+    """
+
+    thread_safe = False
+
+    def __init__(self, name: str, dot_file: str, outputs: Dict[str, str], collector, **kwargs) -> None:
+        """
+        :param collector: The collected graph to render
+        """
+        RenderJob.__init__(self, name, dot_file, outputs, **kwargs)
+        self.collector = collector
+
+    def run(self, timeout: Optional[float] = None) -> float:
+        start = time.monotonic()
+        try:
+            graph = build_agraph(self.collector)
+            # the first option is the engine
+            graph.layout(prog=self.engine, args=" ".join(self.options()[1:]))
+            for file_type, output in self.outputs.items():
+                graph.draw(output, format=file_type)
+        except Exception as e:
+            LOGGER.info("Could not render graph %s in process (%s), rendering it with %s", self.name, e, self.engine)
+            return Job.run(self, timeout)
+        return time.monotonic() - start
+
+
+def build_agraph(collector) -> "pygraphviz.AGraph":
+    """
+    Build the graphviz graph of a collected graph, with the same nodes, clusters and edges as its dot file
+    """
+    graph = pygraphviz.AGraph(strict=False, directed=False, compound="true")
+    clusters = []
+    for node in collector.sorted_nodes():
+        props = {key: str(value) for key, value in collector.node_props(node).items() if value is not None}
+        if collector.subgraph[node]:
+            clusters.append((node, props))
+        else:
+            graph.add_node(collector.node_name(node), **props)
+    for node, props in clusters:
+        children = [collector.node_name(child) for child in collector.sorted_children(node)]
+        graph.add_subgraph(children, name=collector.get_id(node), **props)
+    for edge in collector.sorted_edges():
+        from_id, to_id, props = collector.edge_ends(edge)
+        graph.add_edge(from_id, to_id, **{key: str(value) for key, value in props.items() if value is not None})
+    return graph
+
+
+def bindings_available() -> bool:
+    return pygraphviz is not None
+
+
+def make_job(
+    name: str,
+    dot_file: str,
+    outdir: str,
+    file_types: List[str],
+    engine: str = "dot",
+    engine_options: "Optional[List[str]]" = None,
+    collector=None,
+) -> RenderJob:
+    """
+    Create a render job that writes <outdir>/<name>.<file_type> for each of the file types
+
+    :param collector: Render this collected graph in process when the graphviz bindings are available
+    """
+    outputs = {file_type: os.path.join(outdir, "%s.%s" % (name, file_type)) for file_type in file_types}
+    if collector is not None and bindings_available():
+        return BindingsJob(name, dot_file, outputs, collector, engine=engine, engine_options=engine_options)
+    return RenderJob(name, dot_file, outputs, engine, engine_options)
+
+
+def render_all(jobs: List[Job], workers: Optional[int] = None, timeout: Optional[float] = None) -> Dict[str, float]:
+    """
+    Render all jobs concurrently. The largest graphs are started first so they do not end up at the tail of the queue.
+
+    A render that fails or exceeds the timeout is reported and skipped, it does not affect the other renders.
+
+    :param jobs: The jobs to render
+    :param workers: The maximal number of concurrent renders, defaults to the number of cpus
+    :param timeout: The maximal duration of a single render in seconds, None to wait indefinitely
+    :return: The render duration of each graph that was rendered successfully
+    """
+    jobs = sorted((job for job in jobs if job.pending()), key=lambda job: job.size(), reverse=True)
+    durations = {}
+    if not jobs:
+        return durations
+
+    def report(job: Job, render: "Callable[[], float]") -> None:
+        try:
+            durations[job.name] = render()
+            LOGGER.info("Rendered %s in %.3f seconds", job.describe(), durations[job.name])
+        except subprocess.TimeoutExpired:
+            LOGGER.warning(
+                "Rendering %s timed out after %s seconds, skipped. Render it manually with %s",
+                job.name,
+                timeout,
+                " ".join(job.command()),
+            )
+        except subprocess.CalledProcessError as e:
+            LOGGER.warning(
+                "Could not render %s (exit code %d): %s. Render it manually with %s",
+                job.name,
+                e.returncode,
+                e.stderr.decode(errors="replace").strip() if e.stderr else "",
+                " ".join(job.command()),
+            )
+        except Exception as e:
+            LOGGER.warning("Could not render %s (%s), please execute %s", job.name, e, " ".join(job.command()))
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        futures = {pool.submit(job.run, timeout): job for job in jobs if job.thread_safe}
+        # the jobs that are not thread safe run here, while the pool renders the others
+        for job in jobs:
+            if not job.thread_safe:
+                report(job, lambda: job.run(timeout))
+        for future in as_completed(futures):
+            report(futures[future], future.result)
+
+    return durations
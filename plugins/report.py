@@ -0,0 +1,95 @@
+"""
+    Copyright 2021 Inmanta
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Contact: code@inmanta.com
+"""
+
+import json
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+try:
+    import resource
+except ImportError:
+    # not available on windows
+    resource = None
+
+
+def peak_rss() -> "Dict[str, Optional[int]]":
+    """
+    The peak resident set size in kB of this process and of the largest subprocess that finished
+    """
+    if resource is None:
+        return {"self_kb": None, "subprocess_kb": None}
+    return {
+        "self_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "subprocess_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+
+
+class Report(object):
+    """
+    Timings and counters of an export, written as a json report. A disabled report records nothing.
+    """
+
+    def __init__(self, exporter: str, enabled: bool = True) -> None:
+        self.exporter = exporter
+        self.enabled = enabled
+        # the duration of every phase in seconds, by diagram
+        self.phases: "Dict[str, Dict[str, float]]" = {}
+        # the counters of every diagram
+        self.diagrams: "Dict[str, Dict[str, object]]" = {}
+        # the counters of every line of every diagram
+        self.lines: "List[Dict[str, object]]" = []
+
+    @contextmanager
+    def phase(self, diagram: str, name: str) -> "Iterator[None]":
+        """
+        Time a phase of the export of a diagram, the time of phases with the same name is added up
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            phases = self.phases.setdefault(diagram, {})
+            phases[name] = phases.get(name, 0.0) + time.perf_counter() - start
+
+    def count(self, diagram: str, **counters: object) -> None:
+        if self.enabled:
+            self.diagrams.setdefault(diagram, {}).update(counters)
+
+    def add_line(self, diagram: str, lineno: "Optional[int]", line: str, **counters: object) -> None:
+        if self.enabled:
+            self.lines.append({"diagram": diagram, "lineno": lineno, "line": line, **counters})
+
+    def write(self, path: str) -> None:
+        if not self.enabled:
+            return
+        with open(path, "w") as fd:
+            json.dump(
+                {
+                    "exporter": self.exporter,
+                    "phases": self.phases,
+                    "diagrams": self.diagrams,
+                    "lines": self.lines,
+                    "peak_rss": peak_rss(),
+                },
+                fd,
+                indent=2,
+            )
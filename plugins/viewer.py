@@ -0,0 +1,224 @@
+"""
+    Copyright 2021 Inmanta
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Contact: code@inmanta.com
+"""
+
+import html
+import json
+import os
+from typing import Dict, List, TextIO
+
+# the output type that selects the viewer in the types setting
+VIEWER_TYPE = "viewer"
+
+# the maximal number of nodes in a single data file
+CHUNK_NODES = 2000
+
+# Data files are loaded as scripts that call graphChunk, because browsers do not allow fetch on the local filesystem.
+VIEWER_HTML = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>%(title)s</title>
+<style>
+body { font-family: sans-serif; margin: 1em; }
+details { margin: 0.2em 0; }
+summary { cursor: pointer; }
+ul { margin: 0.2em 0; }
+.entity { color: #777; }
+.target { color: #0645ad; cursor: pointer; }
+</style>
+</head>
+<body>
+<h1>%(title)s</h1>
+<p><input id="search" type="search" placeholder="Search nodes"> <span id="status"></span></p>
+<div id="chunks"></div>
+<script>
+var index = %(index)s;
+var loaded = {};
+var waiting = {};
+
+function graphChunk(number, data) {
+  loaded[number] = data;
+  (waiting[number] || []).forEach(function (callback) { callback(data); });
+  delete waiting[number];
+}
+
+function load(number, callback) {
+  if (loaded[number]) { callback(loaded[number]); return; }
+  if (!waiting[number]) {
+    waiting[number] = [];
+    var script = document.createElement("script");
+    script.src = index.directory + "/" + number + ".js";
+    document.head.appendChild(script);
+  }
+  waiting[number].push(callback);
+}
+
+function text(tag, value, cls) {
+  var element = document.createElement(tag);
+  element.textContent = value;
+  if (cls) { element.className = cls; }
+  return element;
+}
+
+function renderNode(node, data) {
+  var item = document.createElement("li");
+  item.id = "node-" + node[0];
+  item.appendChild(text("span", node[1] + " "));
+  item.appendChild(text("span", node[2], "entity"));
+  var edges = document.createElement("ul");
+  (data.edges[node[0]] || []).forEach(function (edge) {
+    var line = document.createElement("li");
+    line.appendChild(text("span", (edge[2] ? edge[2] + " " : "") + "\\u2014 "));
+    var target = text("span", edge[1], "target");
+    target.onclick = function () { show(edge[3], edge[0]); };
+    line.appendChild(target);
+    edges.appendChild(line);
+  });
+  item.appendChild(edges);
+  return item;
+}
+
+function expand(number, details, filter) {
+  load(number, function (data) {
+    var list = details.querySelector("ul") || details.appendChild(document.createElement("ul"));
+    list.innerHTML = "";
+    data.nodes.forEach(function (node) {
+      if (!filter || node[1].toLowerCase().indexOf(filter) >= 0) { list.appendChild(renderNode(node, data)); }
+    });
+  });
+}
+
+function show(number, id) {
+  var details = document.getElementById("chunk-" + number);
+  details.open = true;
+  expand(number, details, null);
+  load(number, function () {
+    var node = document.getElementById("node-" + id);
+    if (node) { node.scrollIntoView(); }
+  });
+}
+
+index.chunks.forEach(function (chunk, number) {
+  var details = document.createElement("details");
+  details.id = "chunk-" + number;
+  details.appendChild(text("summary", chunk.title + " (" + chunk.nodes + " nodes, " + chunk.edges + " edges)"));
+  details.addEventListener("toggle", function () { if (details.open) { expand(number, details, null); } });
+  document.getElementById("chunks").appendChild(details);
+});
+
+document.getElementById("search").addEventListener("change", function (event) {
+  var filter = event.target.value.toLowerCase();
+  var status = document.getElementById("status");
+  var remaining = index.chunks.length;
+  status.textContent = "searching...";
+  index.chunks.forEach(function (chunk, number) {
+    load(number, function (data) {
+      var details = document.getElementById("chunk-" + number);
+      var found = filter && data.nodes.some(function (node) { return node[1].toLowerCase().indexOf(filter) >= 0; });
+      details.open = Boolean(found);
+      if (found) { expand(number, details, filter); }
+      remaining -= 1;
+      if (remaining === 0) { status.textContent = ""; }
+    });
+  });
+});
+</script>
+</body>
+</html>
+"""
+
+
+def chunk_of(collector) -> "List[str]":
+    """
+    The chunk title of every node: the label of its top-level container, or its entity type when it is not in a container
+    """
+    containers = collector.container_of()
+    titles = []
+    for node in range(len(collector)):
+        top = node
+        seen = set()
+        while top in containers and top not in seen:
+            seen.add(top)
+            top = containers[top]
+        if top in collector.children:
+            titles.append(str(collector.node_props(top).get("label", collector.node_name(top))))
+        else:
+            titles.append(collector.entity_name(node) or "other")
+    return titles
+
+
+def write_viewer(name: str, collector, outdir: str) -> None:
+    """
+    Write an html viewer for the graph to <outdir>/<name>.viewer.html, with its data files in <outdir>/<name>.viewer/.
+
+    The nodes are split in chunks by top-level container or by entity type. The viewer only shows the chunks and loads the
+    nodes and edges of a chunk when it is expanded or searched, so it opens instantly for very large graphs.
+    """
+    titles = chunk_of(collector)
+    groups: "Dict[str, List[int]]" = {}
+    for node in collector.sorted_nodes():
+        groups.setdefault(titles[node], []).append(node)
+
+    chunks = []
+    chunk_number = [0] * len(collector)
+    for title, nodes in sorted(groups.items()):
+        parts = [nodes[i : i + CHUNK_NODES] for i in range(0, len(nodes), CHUNK_NODES)]
+        for part, part_nodes in enumerate(parts):
+            for node in part_nodes:
+                chunk_number[node] = len(chunks)
+            chunks.append(("%s (%d/%d)" % (title, part + 1, len(parts)) if len(parts) > 1 else title, part_nodes))
+
+    # the edges of every node, in both directions, with the chunk of the other end
+    edges: "List[List[List[object]]]" = [[] for _ in range(len(collector))]
+    for edge in collector.sorted_edges():
+        label = collector.edge_options[edge].get("label")
+        label = "" if label is None else str(label)
+        ends = (collector.edge_from[edge], collector.edge_to[edge])
+        for node, other in (ends, ends[::-1]):
+            edges[node].append([collector.node_name(other), _label(collector, other), label, chunk_number[other]])
+
+    directory = "%s.viewer" % name
+    path = os.path.join(outdir, directory)
+    if not os.path.exists(path):
+        os.mkdir(path)
+
+    index = {"directory": directory, "chunks": []}
+    for number, (title, nodes) in enumerate(chunks):
+        data = {
+            "nodes": [
+                [collector.node_name(node), _label(collector, node), collector.entity_name(node) or ""] for node in nodes
+            ],
+            "edges": {collector.node_name(node): edges[node] for node in nodes if edges[node]},
+        }
+        with open(os.path.join(path, "%d.js" % number), "w") as fd:
+            _write_chunk(fd, number, data)
+        index["chunks"].append({"title": title, "nodes": len(nodes), "edges": sum(len(edges[node]) for node in nodes)})
+
+    with open(os.path.join(outdir, "%s.viewer.html" % name), "w") as fd:
+        # escape </ so a label can not end the script element
+        fd.write(VIEWER_HTML % {"title": html.escape(name), "index": json.dumps(index).replace("</", "<\\/")})
+
+
+def _label(collector, node: int) -> str:
+    return str(collector.node_props(node).get("label", collector.node_name(node)))
+
+
+def _write_chunk(fd: "TextIO", number: int, data: "Dict[str, object]") -> None:
+    fd.write("graphChunk(%d, " % number)
+    json.dump(data, fd)
+    fd.write(");\n")
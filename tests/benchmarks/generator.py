@@ -0,0 +1,83 @@
+"""
+    Copyright 2021 Inmanta
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Contact: code@inmanta.com
+"""
+
+from typing import List, Tuple
+
+
+def generate_model(
+    instances: int = 1000,
+    entities: int = 2,
+    fanout: int = 2,
+    depth: int = 3,
+    path: int = 2,
+    nesting: int = 1,
+    diagrams: int = 2,
+) -> "Tuple[str, List[str]]":
+    """
+    Generate a synthetic model for benchmarks: a forest of trees of the given depth. Every level has `entities` entity
+    types and every instance has `fanout` children of each entity type of the next level. The number of trees is chosen
+    so the model has about `instances` instances.
+
+    :param path: The maximal length of the relation paths in the diagrams
+    :param nesting: The number of levels that are drawn as containers of the next level
+    :param diagrams: The number of graph::Graph diagrams, the first one contains everything, the others the leaves and
+        their ancestors up to `path` levels up
+    :return: The model and the filters of the diagrams
+    """
+    per_tree = sum((fanout * entities) ** level for level in range(depth + 1))
+    trees = max(1, instances // per_tree)
+
+    lines = ["import graph", ""]
+    for level in range(depth + 1):
+        lines += ["entity Base%d:" % level, "    string name", "end", "index Base%d(name)" % level, ""]
+        for kind in range(entities):
+            lines += ["entity Level%d_%d extends Base%d:" % (level, kind, level), "end"]
+            lines += ["implement Level%d_%d using std::none" % (level, kind)]
+            if level < depth:
+                lines += ["implement Level%d_%d using children%d" % (level, kind, level)]
+            lines += [""]
+        if level > 0:
+            lines += ["Base%d.children [0:] -- Base%d.parent [1]" % (level - 1, level), ""]
+
+    for level in range(depth):
+        lines += ["implementation children%d for Base%d:" % (level, level)]
+        lines += ["    for i in std::sequence(%d):" % fanout]
+        for kind in range(entities):
+            # every kind gets its share of the children
+            lines += ['        Level%d_%d(parent=self, name="{{self.name}}.{{i}}.%d")' % (level + 1, kind, kind)]
+        lines += ["    end", "end", ""]
+
+    lines += ["for i in std::sequence(%d):" % trees]
+    lines += ['    Level0_0(name="t{{i}}")', "end", ""]
+
+    full = []
+    for level in range(depth + 1):
+        full.append("__config__::Base%d%s" % (level, "[container=true]" if level < nesting else ""))
+        if level > 0:
+            relation = "[type=contained_in]" if level - 1 < nesting else ""
+            full.append("__config__::Base%d.parent%s" % (level, relation))
+    filters = ["\n".join(full)]
+    for diagram in range(1, diagrams):
+        # a subset: the leaves and a multi-hop relation to an ancestor
+        hops = 1 + (diagram - 1) % min(path, depth)
+        filters.append("__config__::Base%d\n__config__::Base%d%s" % (depth, depth, ".parent" * hops))
+
+    for diagram, graph_filter in enumerate(filters):
+        lines.append('graph::Graph(name="diagram%d", config="%s")' % (diagram, graph_filter.replace("\n", "\\n")))
+
+    return "\n".join(lines) + "\n", filters
@@ -0,0 +1,133 @@
+"""
+    Copyright 2021 Inmanta
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Contact: code@inmanta.com
+
+    Benchmarks of the hot paths on synthetic models. The sizes to run are set with GRAPH_BENCHMARK_SIZES, for example
+    GRAPH_BENCHMARK_SIZES=1000,10000,100000. Every stage is compared with the baseline in baselines.json, a stage that is
+    more than GRAPH_BENCHMARK_TOLERANCE times slower (or uses that much more memory) fails. Sizes without a baseline are
+    skipped, baselines are recorded up to 100000 instances. The durations depend on the machine the baselines were recorded
+    on, a slow machine can raise the tolerance or set GRAPH_BENCHMARK_TIMING=0 to only compare the memory. Run with
+    GRAPH_BENCHMARK_UPDATE=1 to record new baselines.
+"""
+
+import gc
+import io
+import json
+import os
+import time
+import tracemalloc
+from typing import Callable, Dict
+
+import pytest
+from generator import generate_model
+from pytest_inmanta.plugin import Project
+
+SIZES = [int(size) for size in os.environ.get("GRAPH_BENCHMARK_SIZES", "1000").split(",")]
+TOLERANCE = float(os.environ.get("GRAPH_BENCHMARK_TOLERANCE", "3"))
+UPDATE = os.environ.get("GRAPH_BENCHMARK_UPDATE", "") == "1"
+TIMED = os.environ.get("GRAPH_BENCHMARK_TIMING", "1") != "0"
+BASELINES = os.path.join(os.path.dirname(__file__), "baselines.json")
+
+# absolute slack on the baselines, so very short stages do not fail on noise
+SLACK_SECONDS = 0.1
+SLACK_KB = 1024
+
+
+def measure(stage: Callable[[], object], repeat: int = 3) -> "Dict[str, float]":
+    """
+    Time a stage as the best of a few runs with the garbage collector disabled, like timeit, and measure its peak memory
+    in one more run with tracemalloc
+    """
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            stage()
+            times.append(time.perf_counter() - start)
+        finally:
+            gc.enable()
+
+    tracemalloc.start()
+    try:
+        stage()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"seconds": round(min(times), 4), "peak_kb": peak // 1024}
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_benchmark(project: Project, tmp_path, size: int) -> None:
+    from inmanta_plugins.graph import CollectionPlan, GraphCollector, NodeNames, generate_plantuml, reduce_graph, write_graph
+
+    from inmanta import config
+
+    model, filters = generate_model(size, diagrams=3)
+    start = time.perf_counter()
+    project.compile(model)
+    results = {"compile": {"seconds": round(time.perf_counter() - start, 4)}}
+    types = project.types
+
+    def collect() -> "Dict[int, GraphCollector]":
+        names = NodeNames()
+        plan = CollectionPlan(names)
+        collectors = {number: GraphCollector(names) for number in range(len(filters))}
+        for number, graph_filter in enumerate(filters):
+            plan.add_diagram(graph_filter, collectors[number])
+        plan.execute(types)
+        return collectors
+
+    collectors = collect()
+    results["collect"] = measure(collect)
+    results["reduce"] = measure(lambda: [reduce_graph("g", c, "", 0, 0, 1000) for c in collectors.values()])
+    results["write dot"] = measure(lambda: [write_graph("g", c, io.StringIO()) for c in collectors.values()])
+    results["plantuml"] = measure(lambda: generate_plantuml(["__config__::.*"], types))
+
+    config.Config.set("graph", "output-dir", str(tmp_path))
+    config.Config.set("graph", "types", "jsonl")
+    config.Config.set("graph", "cache-size", "0")
+    results["export"] = measure(lambda: project._exporter.run_export_plugin("graph"))
+    print("benchmark %d instances: %s" % (size, json.dumps(results)))
+
+    baselines = {}
+    if os.path.exists(BASELINES):
+        with open(BASELINES, "r") as fd:
+            baselines = json.load(fd)
+
+    if UPDATE:
+        baselines[str(size)] = results
+        with open(BASELINES, "w") as fd:
+            json.dump(baselines, fd, indent=2, sort_keys=True)
+            fd.write("\n")
+        return
+
+    baseline = baselines.get(str(size))
+    if baseline is None:
+        pytest.skip("No baseline for %d instances, record one with GRAPH_BENCHMARK_UPDATE=1" % size)
+
+    slower = []
+    for stage, measured in results.items():
+        if stage == "compile":
+            # the compiler is not part of this module, its time is only recorded for reference
+            continue
+        expected = baseline.get(stage, {})
+        if TIMED and "seconds" in expected and measured["seconds"] > expected["seconds"] * TOLERANCE + SLACK_SECONDS:
+            slower.append("%s took %.3fs, baseline %.3fs" % (stage, measured["seconds"], expected["seconds"]))
+        if "peak_kb" in expected and measured["peak_kb"] > expected["peak_kb"] * TOLERANCE + SLACK_KB:
+            slower.append("%s used %dkB, baseline %dkB" % (stage, measured["peak_kb"], expected["peak_kb"]))
+    assert not slower, "Slower than the baseline for %d instances: %s" % (size, ", ".join(slower))
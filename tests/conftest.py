@@ -0,0 +1,55 @@
+"""
+    Copyright 2021 Inmanta
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Contact: code@inmanta.com
+"""
+
+import pytest
+from pytest_inmanta.plugin import Project
+
+MODEL = """
+import graph
+
+entity Host:
+    string name
+end
+
+entity File:
+    string path
+end
+
+Host.files [0:] -- File.host [1]
+
+index Host(name)
+index File(host, path)
+
+implement Host using std::none
+implement File using std::none
+
+h1 = Host(name="h1")
+h2 = Host(name="h2")
+File(host=h1, path="/etc/a")
+File(host=h1, path="/etc/b")
+File(host=h2, path="/etc/c")
+"""
+
+
+@pytest.fixture
+def host_project(project: Project) -> Project:
+    """
+    A project with two hosts and three files, the entities are __config__::Host and __config__::File
+    """
+    project.compile(MODEL)
+    return project
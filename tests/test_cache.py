@@ -0,0 +1,69 @@
+"""
+    Copyright 2021 Inmanta
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Contact: code@inmanta.com
+"""
+
+import os
+
+from conftest import MODEL
+from pytest_inmanta.plugin import Project
+
+CONFIG = """
+__config__::Host[container=true]
+__config__::File[label=path]
+__config__::File.host[type=contained_in]
+"""
+
+
+def test_digest_is_stable(project: Project, tmp_path) -> None:
+    from inmanta_plugins.graph import generate_dot
+    from inmanta_plugins.graph.cache import RenderCache
+
+    cache = RenderCache(str(tmp_path), 2**20)
+
+    project.compile(MODEL)
+    first = generate_dot("g", CONFIG, project.types)
+    project.compile(MODEL)
+    second = generate_dot("g", CONFIG, project.types)
+
+    assert cache.digest(first, ["dot"]) == cache.digest(second, ["dot"])
+    assert cache.digest(first, ["dot"]) != cache.digest(first, ["neato"])
+    assert cache.digest(first, ["dot"]) != cache.digest(first.replace("/etc/a", "/etc/x"), ["dot"])
+
+
+def test_cache_fetch_and_evict(project: Project, tmp_path) -> None:
+    project.compile("import graph")
+    from inmanta_plugins.graph.cache import RenderCache
+
+    cache = RenderCache(str(tmp_path / "cache"), 10)
+    output = str(tmp_path / "g.png")
+
+    assert not cache.consulted
+    assert not cache.fetch("a", "png", output)
+    with open(output, "w") as fd:
+        fd.write("12345678")
+    cache.store("a", "png", output)
+    os.remove(output)
+
+    assert cache.fetch("a", "png", output)
+    assert os.path.exists(output)
+    assert cache.summary() == "Render cache: 1 hits, 1 misses"
+
+    # two entries do not fit, the least recently used one is removed
+    os.utime(str(tmp_path / "cache" / "a.png"), (0, 0))
+    cache.store("b", "png", output)
+    cache.evict()
+    assert os.listdir(str(tmp_path / "cache")) == ["b.png"]
@@ -0,0 +1,77 @@
+"""
+    Copyright 2021 Inmanta
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Contact: code@inmanta.com
+"""
+
+import io
+import json
+from xml.etree import ElementTree
+
+from pytest_inmanta.plugin import Project
+
+GRAPH = """
+__config__::Host[container=true]
+__config__::File[label=path]
+__config__::File.host[type=contained_in]
+__config__::File.host[label=on]
+"""
+
+
+def test_data_formats(host_project: Project) -> None:
+    from inmanta_plugins.graph import GraphCollector, collect_graph
+    from inmanta_plugins.graph.formats import FORMATS
+
+    collector = GraphCollector()
+    collect_graph(GRAPH, host_project.types, collector)
+
+    output = io.StringIO()
+    FORMATS["jsonl"][1](collector, output)
+    records = [json.loads(line) for line in output.getvalue().splitlines()]
+    nodes = [record for record in records if record["type"] == "node"]
+    assert len(nodes) == 5
+    assert sorted(node["label"] for node in nodes if "parent" in node) == ["/etc/a", "/etc/b", "/etc/c"]
+    assert {node["entity"] for node in nodes} == {"__config__::Host", "__config__::File"}
+    assert [record["label"] for record in records if record["type"] == "edge"] == ["on"] * 3
+
+    output = io.StringIO()
+    FORMATS["cytoscape"][1](collector, output)
+    elements = json.loads(output.getvalue())["elements"]
+    assert len(elements["nodes"]) == 5
+    assert len(elements["edges"]) == 3
+
+    output = io.StringIO()
+    FORMATS["graphml"][1](collector, output)
+    graph = ElementTree.fromstring(output.getvalue()).find("{http://graphml.graphdrawing.org/xmlns}graph")
+    assert len(graph.findall("{http://graphml.graphdrawing.org/xmlns}node")) == 5
+    assert len(graph.findall("{http://graphml.graphdrawing.org/xmlns}edge")) == 3
+
+
+def test_data_formats_are_not_reduced(project: Project, tmp_path) -> None:
+    from conftest import MODEL
+
+    from inmanta import config
+
+    project.compile(MODEL + '\ngraph::Graph(name="g", config="""%s""")\n' % GRAPH)
+    config.Config.set("graph", "output-dir", str(tmp_path))
+    config.Config.set("graph", "types", "jsonl")
+    config.Config.set("graph", "max-nodes", "4")
+    project._exporter.run_export_plugin("graph")
+
+    # the laid out graph is aggregated, the data formats contain every instance
+    assert "(3)" in (tmp_path / "g.dot").read_text()
+    with open(tmp_path / "g.jsonl") as fd:
+        records = [json.loads(line) for line in fd]
+    assert len([record for record in records if record["type"] == "node"]) == 5
@@ -0,0 +1,579 @@
+"""
+    Copyright 2021 Inmanta
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Contact: code@inmanta.com
+"""
+
+import io
+import json
+import os
+import re
+from typing import List
+
+import pytest
+from pytest_inmanta.plugin import Project
+
+CONTAINERS = """
+__config__::Host[container=true]
+__config__::File[label=path]
+__config__::File.host[type=contained_in]
+"""
+
+
+def test_write_dot(host_project: Project, tmp_path) -> None:
+    from inmanta_plugins.graph import generate_dot, write_dot
+    from inmanta_plugins.graph.cache import RenderCache
+
+    filename = str(tmp_path / "g.dot")
+    with open(filename, "w") as fd:
+        write_dot("g", CONTAINERS, host_project.types, fd)
+
+    with open(filename, "r") as fd:
+        dot = fd.read()
+
+    assert dot == generate_dot("g", CONTAINERS, host_project.types)
+    assert dot.startswith("graph {\n  // name: g\n  compound=true;\n")
+    assert dot.count("subgraph cluster_") == 2
+    assert dot.count('[label="/etc/') == 3
+
+    cache = RenderCache(str(tmp_path / "cache"), 0)
+    assert cache.digest_file(filename, ["dot"]) == cache.digest(dot, ["dot"])
+
+
+def test_collection_plan_scans_once(host_project: Project, monkeypatch) -> None:
+    from inmanta_plugins.graph import CollectionPlan, GraphCollector, generate_dot, write_graph
+
+    scans = []
+
+    def counting(entity):
+        get_all_instances = entity.get_all_instances
+
+        def wrapper():
+            scans.append(entity.get_full_name())
+            return get_all_instances()
+
+        return wrapper
+
+    types = host_project.types
+    for name in ["__config__::Host", "__config__::File"]:
+        monkeypatch.setattr(types[name], "get_all_instances", counting(types[name]))
+
+    plan = CollectionPlan()
+    first = GraphCollector()
+    second = GraphCollector()
+    plan.add_diagram(CONTAINERS, first)
+    plan.add_diagram("__config__::File[label=path]\n__config__::File.host", second)
+    plan.execute(types)
+
+    assert sorted(scans) == ["__config__::File", "__config__::Host"]
+    assert len(first) == 5
+    assert len(second) == 5
+    assert second.edge_count() == 3
+
+    dot = io.StringIO()
+    write_graph("g", first, dot)
+    assert dot.getvalue().count("subgraph") == generate_dot("g", CONTAINERS, host_project.types).count("subgraph")
+
+
+def test_compile_filter(project: Project) -> None:
+    project.compile("import graph")
+    from inmanta_plugins.graph import EntityConfig, FilterSyntaxException, RelationConfig, compile_filter
+
+    graph_filter = compile_filter('# files\nstd::File[label="{path} on {host}"]\n\n  std::File.host  \n')
+    assert compile_filter('# files\nstd::File[label="{path} on {host}"]\n\n  std::File.host  \n') is graph_filter
+    assert [type(line) for line in graph_filter.lines] == [EntityConfig, RelationConfig]
+    assert [line.lineno for line in graph_filter.entities["std::File"]] == [2, 4]
+    assert graph_filter.lines[0].template.format({"path": "/etc/a", "host": "h1"}) == "/etc/a on h1"
+
+    with pytest.raises(FilterSyntaxException) as e:
+        compile_filter("std::File\nnot a line\nstd::Host\n:: also not")
+    assert e.value.errors == [(2, "not a line"), (4, ":: also not")]
+
+
+def test_relation_traversal(host_project: Project) -> None:
+    from inmanta_plugins.graph import AttributeCache, GraphCollector, compile_filter
+
+    files = host_project.types["__config__::File"].get_all_instances()
+    h1 = [f for f in files if f.get_attribute("path").value == "/etc/a"][0].get_attribute("host").value
+
+    # the diamond file -> host -> files -> host reaches the host only once
+    line = compile_filter("__config__::File.host.files.host").lines[0]
+    attributes = AttributeCache()
+    for file in files:
+        targets = line.collect_targets(file, line.relation, attributes)
+        assert len(targets) == 1
+    # the host -> files -> host suffix is walked once per host
+    assert len([key for key in attributes.targets if key[1] == ("files", "host")]) == 2
+
+    line = compile_filter("__config__::Host.files[fanout=1]").lines[0]
+    assert len(line.collect_targets(h1, line.relation, AttributeCache())) == 1
+    assert "fanout" not in line.options
+
+    collector = GraphCollector()
+    line.collect(collector, host_project.types)
+    assert collector.edge_count() == 2
+
+
+def test_predicates(project: Project) -> None:
+    from conftest import MODEL
+    from inmanta_plugins.graph import (
+        AttributeCache,
+        CollectionPlan,
+        FilterSyntaxException,
+        GraphCollector,
+        NodeNames,
+        TypeIndex,
+        check_predicates,
+        collect_focus,
+        collect_graph,
+        compile_filter,
+    )
+
+    project.compile(
+        MODEL
+        + """
+entity ConfigFile extends File:
+    bool enabled = true
+    number size = 1.0
+end
+implement ConfigFile using std::none
+ConfigFile(host=h2, path="/etc/d")
+"""
+    )
+
+    def collect(graph_filter: str) -> GraphCollector:
+        collector = GraphCollector()
+        collect_graph(graph_filter, project.types, collector)
+        return collector
+
+    collector = collect('__config__::File[label=path, where path~"^/etc/(a|d)$"]')
+    assert sorted(collector.labels) == ["/etc/a", "/etc/d"]
+    collector = collect('__config__::File[label=path, where path!=/etc/a and path~"/etc/[bc]"]')
+    assert sorted(collector.labels) == ["/etc/b", "/etc/c"]
+
+    collector = collect("__config__::Host.files|__config__::ConfigFile")
+    assert collector.edge_count() == 1
+    assert sorted(instance.get_attribute("path").value for instance in collector.instances[1:]) == ["/etc/d"]
+    collector = collect('__config__::Host[where name=h1]\n__config__::Host.files|path="/etc/b"')
+    assert len(collector) == 2
+    assert collector.edge_count() == 1
+    assert collector.instances[1].get_attribute("path").value == "/etc/b"
+
+    # targets that do not pass the filter are not followed any further
+    line = compile_filter("__config__::File.host|name=h1.files").lines[0]
+    attributes = AttributeCache()
+    targets = {
+        file.get_attribute("path").value: line.collect_targets(file, line.relation, attributes)
+        for file in project.types["__config__::File"].get_all_instances()
+    }
+    assert [len(targets[path]) for path in sorted(targets)] == [2, 2, 0, 0]
+    assert {key[0].get_attribute("name").value for key in attributes.targets if key[1] == ("files",)} == {"h1"}
+
+    # the instances that are filtered out are not named
+    names = NodeNames()
+    plan = CollectionPlan(names)
+    plan.add_diagram("__config__::File[where path=/etc/a]", GraphCollector(names))
+    plan.execute(project.types)
+    assert [instance.get_attribute("path").value for instance in names.names if "path" in instance.slots] == ["/etc/a"]
+
+    # values are compared on their literal in the model
+    assert len(collect("__config__::File[where enabled=true and size=1]")) == 1
+    assert len(collect("__config__::File[where enabled!=false]")) == 1
+
+    # the attribute values of a focus are compared like predicates
+    collector = GraphCollector()
+    collect_focus("__config__::File", project.types, collector, "__config__::ConfigFile[enabled=true, size=1]", 0)
+    assert len(collector) == 1
+
+    # a relation can not be compared with a value
+    index = TypeIndex(project.types)
+    check_predicates(compile_filter("__config__::Host.files|enabled=true"), index)
+    with pytest.raises(FilterSyntaxException):
+        check_predicates(compile_filter("__config__::File[where host=h1]"), index)
+    with pytest.raises(FilterSyntaxException):
+        check_predicates(compile_filter("__config__::Host.files|host=h1"), index)
+
+    with pytest.raises(FilterSyntaxException):
+        compile_filter('__config__::File[where path~"("]')
+    with pytest.raises(FilterSyntaxException):
+        compile_filter("__config__::Host.files|ConfigFile")
+
+
+def test_graph_store(project: Project) -> None:
+    project.compile("import graph")
+    from inmanta_plugins.graph import GraphCollector
+
+    a, b, c = object(), object(), object()
+    collector = GraphCollector()
+    collector.add_node(a, shape="box", label="a")
+    collector.add_node(b, shape="box", label="b")
+    # nodes with the same options share them
+    assert collector.options[0] is collector.options[1]
+    assert collector.node_props(0) == {"shape": "box", "label": "a"}
+
+    collector.add_relation(a, b, label="x")
+    collector.add_relation(b, a, label="x", color="red")
+    collector.add_relation(a, b, label="y")
+    collector.add_relation(a, c)
+    assert len(collector) == 3
+    assert collector.edge_count() == 3
+    # the duplicate edge overwrites the first one
+    assert (collector.edge_from[0], collector.edge_to[0]) == (1, 0)
+    assert collector.edge_options[0] == {"color": "red", "label": "x"}
+
+    collector.add_child(collector.get_node(c), collector.get_node(a))
+    dot = collector.dump_dot()
+    assert "subgraph cluster_%s {" % collector.node_name(2) in dot
+    assert 'lhead="cluster_%s"' % collector.node_name(2) in dot
+
+
+def test_aggregate(host_project: Project) -> None:
+    from conftest import MODEL
+    from inmanta_plugins.graph import GraphCollector, aggregate, collect_graph, reduce_graph
+
+    collector = GraphCollector()
+    collect_graph("__config__::Host\n__config__::File[aggregate=host]\n__config__::File.host", host_project.types, collector)
+    assert len(collector) == 5
+
+    summary = aggregate(collector)
+    labels = sorted(summary.labels[node] for node in range(len(summary)))
+    assert labels == ["__config__::File host=h1 (2)", "__config__::File host=h2 (1)", "h1", "h2"]
+    assert summary.edge_count() == 2
+    weights = sorted(options.get("weight", 1) for options in summary.edge_options)
+    assert weights == [1, 2]
+
+    # a list relation is grouped on the names of the related instances, which do not change between compiles
+    def groups() -> List[str]:
+        collector = GraphCollector()
+        collect_graph("__config__::Host[aggregate=files]", host_project.types, collector)
+        return sorted(aggregate(collector).labels)
+
+    first = groups()
+    host_project.compile(MODEL)
+    assert groups() == first
+    assert first[0].startswith("__config__::Host files=[__config___File_")
+
+    # over budget, all instances are aggregated by entity type
+    collector = GraphCollector()
+    collect_graph("__config__::Host\n__config__::File\n__config__::File.host", host_project.types, collector)
+    assert reduce_graph("g", collector, "", 5, 0) is collector
+    reduced = reduce_graph("g", collector, "", 4, 0)
+    assert sorted(reduced.labels) == ["__config__::File (3)", "__config__::Host (2)"]
+    assert reduced.edge_count() == 1
+    assert reduced.edge_options[0]["weight"] == 3
+
+
+def test_fold_hubs(host_project: Project) -> None:
+    from inmanta_plugins.graph import GraphCollector, collect_graph, fold_hubs
+
+    collector = GraphCollector()
+    collect_graph("__config__::Host\n__config__::File[label=path]\n__config__::File.host", host_project.types, collector)
+
+    folded, report = fold_hubs("g", collector, 1)
+    assert report == {"h1": 2}
+    assert sorted(folded.labels) == ["+2 __config__::File", "/etc/c", "h1", "h2"]
+    assert folded.edge_count() == 2
+
+    # keep the first leaf that matches the pattern, a single remaining leaf is not folded
+    folded, report = fold_hubs("g", collector, 1, keep=1, keep_pattern="b$")
+    assert report == {}
+    assert folded is collector
+
+
+def test_focus(host_project: Project) -> None:
+    from inmanta_plugins.graph import GraphCollector, collect_focus
+
+    graph_filter = "__config__::Host\n__config__::File[label=path]\n__config__::Host.files\n__config__::File.host"
+
+    collector = GraphCollector()
+    collect_focus(graph_filter, host_project.types, collector, "__config__::Host[name=h1]", 1)
+    assert sorted(collector.labels) == ["/etc/a", "/etc/b", "h1"]
+    assert collector.edge_count() == 2
+
+    collector = GraphCollector()
+    collect_focus(graph_filter, host_project.types, collector, "__config__::File[path=/etc/c]", 2)
+    assert sorted(collector.labels) == ["/etc/c", "h2"]
+
+    collector = GraphCollector()
+    collect_focus(graph_filter, host_project.types, collector, "__config__::Host", 0)
+    assert sorted(collector.labels) == ["h1", "h2"]
+    assert collector.edge_count() == 0
+
+    collector = GraphCollector()
+    collect_focus(graph_filter, host_project.types, collector, "__config__::Host[where name!=h2]", 0)
+    assert sorted(collector.labels) == ["h1"]
+
+    # relation lines are walked backwards from their target as well
+    graph_filter = "__config__::Host\n__config__::File[label=path]\n__config__::File.host[type=contained_in]"
+    collector = GraphCollector()
+    collect_focus(graph_filter, host_project.types, collector, '__config__::Host[name="h1"]', 1)
+    assert sorted(collector.labels) == ["/etc/a", "/etc/b", "h1"]
+    assert len(collector.children[collector.get_node(collector.instances[0])]) == 2
+
+
+def test_partition(host_project: Project) -> None:
+    from inmanta_plugins.graph import GraphCollector, collect_graph, partition, write_index
+
+    collector = GraphCollector()
+    collect_graph(CONTAINERS, host_project.types, collector)
+    files = {collector.labels[node]: collector.instances[node] for node in range(len(collector))}
+    collector.add_relation(files["/etc/a"], files["/etc/c"], label="link")
+
+    pages, overview = partition("g", collector, "svg")
+    assert [page.name for page in pages] == ["g-1", "g-2"]
+    assert sorted(page.title for page in pages) == ["h1", "h2"]
+    for page in pages:
+        # the container, its files and a stub for the other page
+        assert page.collector.edge_count() == 1
+        assert len(page.collector) == len(page.collector.children[0]) + 2
+        assert "-> " in page.collector.dump_dot()
+
+    assert len(overview) == 2
+    assert overview.edge_count() == 1
+    assert 'URL="g-1.svg"' in overview.dump_dot()
+
+    index = io.StringIO()
+    write_index("g", pages, "svg", index)
+    assert '<img src="g.svg"' in index.getvalue()
+    assert '<a href="g-2.svg">' in index.getvalue()
+
+    # a file in the containers of both hosts is placed on one page and linked from the other
+    hosts = {collector.labels[node]: node for node in collector.children}
+    collector.add_child(hosts["h2"], collector.get_node(files["/etc/a"]))
+    pages, overview = partition("g", collector, "svg")
+    assert sorted(len(page.collector.children[0]) for page in pages) == [1, 2]
+    assert sorted(page.collector.edge_count() for page in pages) == [1, 2]
+    for page in pages:
+        assert "subgraph cluster_" in page.collector.dump_dot()
+    assert overview.edge_options[0]["label"] == "2"
+
+
+def test_paged_export(project: Project, tmp_path) -> None:
+    from conftest import MODEL
+
+    from inmanta import config
+
+    project.compile(MODEL + '\ngraph::Graph(name="g", config="""%s""", paged=true)\n' % CONTAINERS)
+    config.Config.set("graph", "output-dir", str(tmp_path))
+    config.Config.set("graph", "types", "jsonl")
+    # the whole graph is over the budget, every page fits in it
+    config.Config.set("graph", "max-nodes", "4")
+    project._exporter.run_export_plugin("graph")
+
+    pages = [(tmp_path / ("g-%d.dot" % number)).read_text() for number in (1, 2)]
+    assert sorted(page.count("/etc/") for page in pages) == [1, 2]
+    assert "(3)" not in "".join(pages)
+
+
+def test_delta(host_project: Project) -> None:
+    from inmanta_plugins.graph import GraphCollector, collect_graph, delta_graph, snapshot
+
+    collector = GraphCollector()
+    collect_graph("__config__::Host\n__config__::File[label=path]\n__config__::File.host", host_project.types, collector)
+    current = snapshot(collector)
+    names = {label: name for name, (label, _) in current["nodes"].items()}
+
+    assert len(delta_graph(collector, current, current)) == 0
+
+    previous = json.loads(json.dumps(current))
+    # /etc/a is added, /etc/b is modified and /etc/old is removed
+    del previous["nodes"][names["/etc/a"]]
+    previous["edges"] = [edge for edge in previous["edges"] if names["/etc/a"] not in edge]
+    previous["nodes"][names["/etc/b"]][1] = "0"
+    previous["nodes"]["old"] = ["/etc/old", "0"]
+    previous["edges"].append(["old", names["h1"], ""])
+
+    delta = delta_graph(collector, current, previous)
+    colors = {delta.labels[node]: delta.options[node]["fillcolor"] for node in range(len(delta))}
+    assert colors == {"/etc/a": "palegreen", "/etc/b": "orange", "/etc/old": "lightcoral", "h1": "gray90"}
+    assert sorted(options["color"] for options in delta.edge_options) == ["gray", "green", "red"]
+
+
+def test_delta_export(project: Project, tmp_path) -> None:
+    from conftest import MODEL
+
+    from inmanta import config
+
+    graph = '\ngraph::Graph(name="g", config="__config__::Host\\n__config__::File[label=path]\\n__config__::File.host")\n'
+
+    def export(model: str) -> None:
+        project.compile(model + graph)
+        config.Config.set("graph", "output-dir", str(tmp_path))
+        config.Config.set("graph", "types", "jsonl")
+        config.Config.set("graph", "delta", "true")
+        # the whole graph is over the budget, the delta compares the instances
+        config.Config.set("graph", "max-nodes", "4")
+        project._exporter.run_export_plugin("graph")
+
+    export(MODEL)
+    assert not (tmp_path / "g.delta.dot").exists()
+
+    # a snapshot that can not be read is ignored
+    (tmp_path / "g.snapshot.json").write_text('{"nodes": ')
+    export(MODEL)
+    assert not (tmp_path / "g.delta.dot").exists()
+
+    # nothing changed
+    export(MODEL)
+    assert not (tmp_path / "g.delta.dot").exists()
+
+    export(MODEL + 'File(host=h2, path="/etc/x")\n')
+    dot = (tmp_path / "g.delta.dot").read_text()
+    assert 'label="/etc/x"' in dot
+    assert "(4)" not in dot
+
+
+def test_stable_output(project: Project) -> None:
+    from conftest import MODEL
+    from inmanta_plugins.graph import generate_dot
+
+    config = CONTAINERS + "__config__::Host.files[label=file]\n"
+    project.compile(MODEL)
+    first = generate_dot("g", config, project.types)
+    project.compile(MODEL)
+    second = generate_dot("g", config, project.types)
+
+    assert first == second
+    # index based names
+    assert "subgraph cluster___config___Host_" in first
+    assert '"__config___File_' in first
+
+
+def test_stable_output_without_index(project: Project) -> None:
+    from inmanta_plugins.graph import generate_dot
+
+    model = """
+import graph
+
+entity Host:
+    string name
+end
+
+entity Port:
+    int n
+end
+
+Host.ports [0:] -- Port.host [1]
+
+index Host(name)
+
+implement Host using std::none
+implement Port using std::none
+
+Port(n=1, host=Host(name="h1"))
+Port(n=1, host=Host(name="h2"))
+Port(n=1, host=Host(name="h3"))
+"""
+    config = "__config__::Host\n__config__::Port\n__config__::Port.host"
+
+    dots = set()
+    for _ in range(5):
+        project.compile(model)
+        dots.add(generate_dot("g", config, project.types))
+
+    assert len(dots) == 1
+    dot = dots.pop()
+    # the ports are told apart by their host, not by the order in which they are named
+    assert len(set(re.findall(r'"(__config___Port_\w+)"', dot))) == 3
+    assert not re.search(r"__config___Port_\w+_1", dot)
+    # unlabelled nodes are labelled with their name by graphviz, not with the repr of the instance
+    assert "label" not in "".join(line for line in dot.splitlines() if line.strip().startswith('"__config___Port'))
+
+
+def test_type_selectors(project: Project) -> None:
+    from conftest import MODEL
+    from inmanta_plugins.graph import TypeIndex, generate_dot
+
+    project.compile(
+        MODEL
+        + """
+entity ConfigFile extends File:
+end
+implement ConfigFile using std::none
+ConfigFile(host=h2, path="/etc/d")
+"""
+    )
+    index = TypeIndex(project.types)
+
+    assert index.resolve("__config__::*") == ["__config__::File", "__config__::Host"]
+    assert index.resolve("__config__::**") == ["__config__::File", "__config__::Host"]
+    assert index.resolve("/__config__::.*File/") == ["__config__::File"]
+    assert index.resolve("/.*::Config.*/") == ["__config__::ConfigFile"]
+    assert index.resolve("subclasses-of(__config__::File)") == ["__config__::ConfigFile"]
+    assert index.resolve("__config__::Missing") == []
+
+    dot = generate_dot("g", "subclasses-of(__config__::File)[label=path]\n/__config__::Ho.*/.files", project.types)
+    assert dot.count("[label=") == 1
+    assert dot.count(" -- ") == 4
+
+
+def test_class_index(host_project: Project) -> None:
+    from inmanta_plugins.graph import ClassIndex, generate_plantuml
+
+    types = host_project.types
+    index = ClassIndex(types)
+    combined = generate_plantuml(["__config__::.*"], types, index=index)
+    assert combined == generate_plantuml(["__config__::.*"], types)
+    assert '__config__::Host "*" -- "1" __config__::File : files >' in combined
+
+    # the fragments are generated once and shared by all diagrams
+    host = types["__config__::Host"]
+    fragment = index.emit_class(host)
+    assert generate_plantuml(["__config__::Host"], types, index=index).startswith(fragment + "\n")
+    assert index.emit_class(host) is fragment
+    assert ClassIndex.module(host) == "__config__"
+
+
+def test_class_diagram_fragments(host_project: Project, tmp_path) -> None:
+    from inmanta_plugins.graph import ClassIndex, generate_plantuml, generate_plantuml_fragments, write_fragments
+
+    types = host_project.types
+    index = ClassIndex(types)
+    fragments = generate_plantuml_fragments(["__config__::.*", "graph::.*"], types, index=index)
+    assert sorted(fragments) == ["__config__", "graph"]
+    combined = generate_plantuml(["__config__::.*", "graph::.*"], types, index=index)
+    assert sorted(combined.split("\n")) == sorted("\n".join(fragments.values()).split("\n"))
+
+    files = write_fragments(str(tmp_path), "d", ["__config__::.*", "graph::.*"], types, index)
+    assert files == [str(tmp_path / "d" / "__config__.puml"), str(tmp_path / "d" / "graph.puml")]
+    # unchanged fragments are not written again
+    mtime = os.stat(files[0]).st_mtime_ns
+    os.utime(files[0], ns=(0, 0))
+    write_fragments(str(tmp_path), "d", ["__config__::.*", "graph::.*"], types, index)
+    assert os.stat(files[0]).st_mtime_ns == 0 != mtime
+
+
+def test_report(project: Project, tmp_path) -> None:
+    from conftest import MODEL
+
+    from inmanta import config
+
+    project.compile(MODEL + '\ngraph::Graph(name="g", config="__config__::Host\\n__config__::File\\n__config__::File.host")\n')
+    config.Config.set("graph", "output-dir", str(tmp_path))
+    config.Config.set("graph", "types", "jsonl")
+    config.Config.set("graph", "report", "true")
+    project._exporter.run_export_plugin("graph")
+
+    with open(tmp_path / "graph-report.json") as fd:
+        report = json.load(fd)
+    assert "collect" in report["phases"]["*"]
+    assert "write dot" in report["phases"]["g"]
+    assert report["diagrams"]["g"]["nodes"] == 5
+    assert report["diagrams"]["g"]["dot_bytes"] == os.path.getsize(tmp_path / "g.dot")
+    assert [(line["lineno"], line["scanned"], line["nodes"], line["edges"]) for line in report["lines"]] == [
+        (1, 2, 2, 0),
+        (2, 3, 3, 0),
+        (3, 3, 0, 3),
+    ]
@@ -0,0 +1,131 @@
+"""
+    Copyright 2021 Inmanta
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Contact: code@inmanta.com
+"""
+
+import pytest
+from pytest_inmanta.plugin import Project
+
+
+def test_single_layout(project: Project) -> None:
+    project.compile("import graph")
+    from inmanta_plugins.graph.render import make_job
+
+    job = make_job("g", "out/g.dot", "out", ["png", "svg"])
+    cmd = job.command()
+
+    # one dot invocation renders all formats
+    assert cmd[0] == "dot"
+    assert cmd[-1] == "out/g.dot"
+    assert cmd.count("-o") == 2
+    assert cmd[cmd.index("-Tpng") + 2] == "out/g.png"
+    assert cmd[cmd.index("-Tsvg") + 2] == "out/g.svg"
+
+
+def test_engine_selection(project: Project) -> None:
+    project.compile("import graph")
+    from inmanta_plugins.graph.render import DOT_OPTIONS, make_job, select_engine
+
+    assert select_engine(100, 200) == "dot"
+    assert select_engine(3000, 200) == "sfdp"
+    assert select_engine(100, 200, max_edges=100) == "sfdp"
+
+    job = make_job("g", "out/g.dot", "out", ["svg"], "sfdp", ["-Gsize=10"])
+    assert job.options()[0] == "sfdp"
+    assert job.options()[-1] == "-Gsize=10"
+    assert make_job("g", "out/g.dot", "out", ["svg"]).options() == ["dot"] + DOT_OPTIONS
+    assert make_job("g", "out/g.dot", "out", ["svg"], "circo").options() == ["circo"]
+
+
+def test_render_all_skips_failures(project: Project) -> None:
+    project.compile("import graph")
+    from inmanta_plugins.graph.render import RenderJob, render_all
+
+    class CommandJob(RenderJob):
+        def __init__(self, name, cmd):
+            RenderJob.__init__(self, name, "", {"png": ""})
+            self.cmd = cmd
+
+        def command(self):
+            return self.cmd
+
+    durations = render_all(
+        [CommandJob("slow", ["sleep", "10"]), CommandJob("broken", ["false"]), CommandJob("ok", ["true"])],
+        workers=2,
+        timeout=0.5,
+    )
+    assert list(durations.keys()) == ["ok"]
+
+
+def test_plantuml_batches(project: Project, tmp_path) -> None:
+    project.compile("import graph")
+    from inmanta_plugins.graph import render_plantuml
+    from inmanta_plugins.graph.render import make_plantuml_jobs
+
+    files = [str(tmp_path / ("d%d.puml" % i)) for i in range(3)]
+    for filename in files:
+        with open(filename, "w") as fd:
+            fd.write("@startuml\nclass %s\n@enduml\n" % filename)
+
+    jobs = make_plantuml_jobs(["plantuml"], files, ["svg", "png"], 2)
+    assert [job.command() for job in jobs] == [
+        ["plantuml", "-tsvg", files[0], files[2]],
+        ["plantuml", "-tsvg", files[1]],
+        ["plantuml", "-tpng", files[0], files[2]],
+        ["plantuml", "-tpng", files[1]],
+    ]
+    assert jobs[0].describe() == "2 class diagrams with PlantUML to svg"
+
+    # a fake plantuml that records every file it renders
+    log = tmp_path / "rendered"
+    plantuml = ["sh", "-c", 'shift; for f in "$@"; do echo "$f" >> %s; echo svg > "${f%%.puml}.svg"; done' % log, "plantuml"]
+    render_plantuml(str(tmp_path), plantuml, files)
+    assert sorted(log.read_text().split()) == files
+    assert (tmp_path / "d0.svg").read_text() == "svg\n"
+
+    # only the changed diagram is rendered again
+    with open(files[1], "a") as fd:
+        fd.write("' changed\n")
+    render_plantuml(str(tmp_path), plantuml, files)
+    assert sorted(log.read_text().split()) == sorted(files + [files[1]])
+
+
+def test_bindings(host_project: Project, tmp_path, monkeypatch) -> None:
+    from inmanta_plugins.graph import GraphCollector, collect_graph, render
+    from inmanta_plugins.graph.render import BindingsJob, RenderJob, make_job, render_all
+
+    collector = GraphCollector()
+    collect_graph(
+        "__config__::Host[container=true]\n__config__::File[label=path]\n__config__::File.host[type=contained_in]",
+        host_project.types,
+        collector,
+    )
+
+    # without the bindings the graph is rendered with a subprocess
+    monkeypatch.setattr(render, "pygraphviz", None)
+    assert type(make_job("g", "g.dot", str(tmp_path), ["svg"], collector=collector)) is RenderJob
+    monkeypatch.undo()
+
+    pytest.importorskip("pygraphviz")
+    graph = render.build_agraph(collector)
+    assert len(graph.nodes()) == 3
+    assert len(graph.subgraphs()) == 2
+
+    job = make_job("g", "g.dot", str(tmp_path), ["svg", "png"], collector=collector)
+    assert isinstance(job, BindingsJob)
+    assert list(render_all([job])) == ["g"]
+    assert (tmp_path / "g.svg").read_text().count('<g id="clust') == 2
+    assert (tmp_path / "g.png").exists()
@@ -0,0 +1,69 @@
+"""
+    Copyright 2021 Inmanta
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+        http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+    Contact: code@inmanta.com
+"""
+
+import json
+import os
+
+from pytest_inmanta.plugin import Project
+
+GRAPH = """
+__config__::Host[container=true]
+__config__::File[label=path]
+__config__::File.host[type=contained_in]
+__config__::File.host[label=on]
+"""
+
+
+def test_viewer(host_project: Project, tmp_path) -> None:
+    from inmanta_plugins.graph import GraphCollector, collect_graph
+    from inmanta_plugins.graph.viewer import write_viewer
+
+    collector = GraphCollector()
+    collect_graph(GRAPH, host_project.types, collector)
+    write_viewer("g", collector, str(tmp_path))
+
+    with open(tmp_path / "g.viewer.html") as fd:
+        page = fd.read()
+    index = json.loads(page.split("var index = ", 1)[1].split(";\n", 1)[0])
+    # one chunk per host, the files are in the chunk of their host
+    assert sorted((chunk["title"], chunk["nodes"]) for chunk in index["chunks"]) == [("h1", 3), ("h2", 2)]
+    assert sorted(os.listdir(tmp_path / "g.viewer")) == ["0.js", "1.js"]
+
+    with open(tmp_path / "g.viewer" / "0.js") as fd:
+        chunk = fd.read()
+    assert chunk.startswith("graphChunk(0, ")
+    data = json.loads(chunk[len("graphChunk(0, ") : -len(");\n")])
+    assert sorted(node[1] for node in data["nodes"]) == ["/etc/a", "/etc/b", "h1"]
+    assert sum(len(edges) for edges in data["edges"].values()) == 4
+
+
+def test_viewer_is_not_reduced(project: Project, tmp_path) -> None:
+    from conftest import MODEL
+
+    from inmanta import config
+
+    project.compile(MODEL + '\ngraph::Graph(name="g", config="""%s""")\n' % GRAPH)
+    config.Config.set("graph", "output-dir", str(tmp_path))
+    config.Config.set("graph", "types", "viewer")
+    config.Config.set("graph", "max-nodes", "4")
+    project._exporter.run_export_plugin("graph")
+
+    with open(tmp_path / "g.viewer.html") as fd:
+        page = fd.read()
+    index = json.loads(page.split("var index = ", 1)[1].split(";\n", 1)[0])
+    assert sorted((chunk["title"], chunk["nodes"]) for chunk in index["chunks"]) == [("h1", 3), ("h2", 2)]